@@ -0,0 +1,159 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import partial
+from itertools import islice
+from typing import List, Type, Iterable, Union, AsyncGenerator, Any, Callable, Iterator
+
+from sqlite_lib import DBManager, Entry, Table, Expression, Select, Page
+
+
+class AsyncSelect(Select):
+    def __init__(self, db: "AsyncDBManager", entry_type: Type[Entry], *columns: Expression):
+        super().__init__(db.db, entry_type, *columns)
+        self.__db = db
+
+    def __aiter__(self):
+        return self.__db.stream(lambda: iter(Select.__iter__(self)))
+
+    async def all(self) -> List[Any]:
+        return [row async for row in self]
+
+    async def first(self):
+        rows = self.__aiter__()
+        try:
+            return await anext(rows, None)
+        finally:
+            await rows.aclose()
+
+
+class AsyncDBManager:
+    def __init__(self, path: str, tables: List[Table] = None, **kwargs):
+        self.db: DBManager = None
+        self.__args = path, tables, kwargs
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.__lock = asyncio.Lock()
+        self.__owner: ContextVar = ContextVar(f"sqlite_transaction_{id(self)}", default=None)
+        self.__active: object = None
+
+    async def open(self):
+        path, tables, kwargs = self.__args
+        self.db = await self.__call(DBManager, path, tables, **kwargs)
+        return self
+
+    async def close(self):
+        if self.db is not None:
+            await self.__run(self.db.close)
+        self.__executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def execute(self, sql, *args):
+        await self.__run(self.db.execute, sql, *args)
+
+    async def commit(self):
+        await self.__run(self.db.commit)
+
+    async def insert_entries(self, entries: Iterable[Entry], **kwargs) -> Union[int, List[int]]:
+        return await self.__run(self.db.insert_entries, [*entries], **kwargs)
+
+    async def upsert_entries(self, entries: Iterable[Entry], **kwargs) -> int:
+        return await self.__run(self.db.upsert_entries, [*entries], **kwargs)
+
+    async def update_entries(self, entries: Iterable[Entry], **kwargs) -> int:
+        return await self.__run(self.db.update_entries, [*entries], **kwargs)
+
+    async def delete_entries(self, entries: Iterable[Any], **kwargs) -> int:
+        return await self.__run(self.db.delete_entries, [*entries], **kwargs)
+
+    async def aggregate(self, entry_type: Type[Entry], *columns: Expression, **kwargs):
+        return await self.__run(self.db.aggregate, entry_type, *columns, **kwargs)
+
+    async def paginate(self, entry_type: Type[Entry], **kwargs) -> Page:
+        return await self.__run(self.db.paginate, entry_type, **kwargs)
+
+    async def get(self, entry_type: Type[Entry], key) -> Entry:
+        return await self.__run(self.db.get, entry_type, key)
+
+    async def get_many(self, entry_type: Type[Entry], keys: Iterable[Any], **kwargs) -> List[Entry]:
+        return await self.__run(self.db.get_many, entry_type, [*keys], **kwargs)
+
+    async def flush(self, entries: Iterable[Entry], **kwargs) -> int:
+        return await self.__run(self.db.flush, [*entries], **kwargs)
+
+    async def create_indexes(self, *entry_types: Type[Entry]):
+        await self.__run(self.db.create_indexes, *entry_types)
+
+    async def drop_indexes(self, *entry_types: Type[Entry]):
+        await self.__run(self.db.drop_indexes, *entry_types)
+
+    def get_entries(self, entry_type: Type[Entry], arraysize: int = None, lazy=False) -> AsyncGenerator[Entry, None]:
+        return self.stream(partial(self.db.get_entries, entry_type, arraysize=arraysize, lazy=lazy), arraysize)
+
+    def fetch(self, sql, *args, row_factory=None, arraysize: int = None) -> AsyncGenerator[Any, None]:
+        return self.stream(partial(self.db.fetch, sql, *args, row_factory=row_factory, arraysize=arraysize), arraysize)
+
+    def select(self, entry_type: Type[Entry], *columns: Expression) -> AsyncSelect:
+        return AsyncSelect(self, entry_type, *columns)
+
+    async def stream(self, rows: Callable[[], Iterator[Any]], arraysize: int = None) -> AsyncGenerator[Any, None]:
+        arraysize = arraysize or self.db.arraysize
+        rows = await self.__call(rows)
+
+        try:
+            while True:
+                chunk = await self.__run(lambda: [*islice(rows, arraysize)])
+                for row in chunk:
+                    yield row
+                if len(chunk) < arraysize:
+                    break
+        finally:
+            await self.__call(rows.close)
+
+    @asynccontextmanager
+    async def transaction(self):
+        if self.__owns():
+            async with self.__transaction():
+                yield self
+            return
+
+        async with self.__lock:
+            self.__active = object()
+            token = self.__owner.set(self.__active)
+            try:
+                async with self.__transaction():
+                    yield self
+            finally:
+                self.__owner.reset(token)
+                self.__active = None
+
+    def __owns(self) -> bool:
+        return self.__active is not None and self.__owner.get() is self.__active
+
+    @asynccontextmanager
+    async def __transaction(self):
+        context = self.db.transaction()
+        await self.__call(context.__enter__)
+
+        try:
+            yield
+        except BaseException as e:
+            await self.__call(context.__exit__, type(e), e, e.__traceback__)
+            raise
+
+        await self.__call(context.__exit__, None, None, None)
+
+    async def __run(self, function, *args, **kwargs):
+        if self.__owns():
+            return await self.__call(function, *args, **kwargs)
+
+        async with self.__lock:
+            return await self.__call(function, *args, **kwargs)
+
+    async def __call(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, partial(function, *args, **kwargs))
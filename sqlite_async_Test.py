@@ -0,0 +1,75 @@
+import asyncio
+import unittest
+import sqlite_lib as sql_lib
+from sqlite_async import AsyncDBManager
+
+
+class User(sql_lib.Entry):
+    id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+    username = sql_lib.TEXT()
+
+
+class AsyncDBManagerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = await AsyncDBManager(":memory:", tables=[sql_lib.Table("users", User)]).open()
+
+    async def asyncTearDown(self):
+        await self.db.close()
+
+    async def test_insert_and_stream(self):
+        self.assertEqual(10, await self.db.insert_entries(User(username=str(i)) for i in range(10)))
+
+        entries = [entry.username async for entry in self.db.get_entries(User, arraysize=3)]
+        self.assertEqual([str(i) for i in range(10)], entries)
+
+        query = self.db.select(User).where(User.id > 8).order_by(User.id.desc())
+        self.assertEqual(["9", "8"], [entry.username for entry in await query.all()])
+        self.assertEqual("8", (await self.db.select(User).where(User.id > 8).first()).username)
+
+    async def test_transaction_rollback(self):
+        with self.assertRaises(KeyError):
+            async with self.db.transaction():
+                await self.db.insert_entries([User(username="a")])
+                raise KeyError
+
+        self.assertEqual([], [entry async for entry in self.db.get_entries(User)])
+
+    async def test_transaction_isolated_from_other_tasks(self):
+        order = []
+
+        async def writer():
+            async with self.db.transaction():
+                await self.db.insert_entries([User(username="a")])
+                await asyncio.sleep(.01)
+                order.append("commit")
+
+        async def reader():
+            await asyncio.sleep(0)
+            order.append(len([entry async for entry in self.db.get_entries(User)]))
+
+        await asyncio.gather(writer(), reader())
+        self.assertEqual(["commit", 1], order)
+
+    async def test_child_tasks_share_transaction(self):
+        async with self.db.transaction():
+            await self.db.insert_entries([User(username="a"), User(username="b")])
+            entry = await asyncio.wait_for(asyncio.create_task(self.db.get(User, 1)), 1)
+            entries = await asyncio.wait_for(asyncio.gather(self.db.get(User, 2), self.db.get(User, 3)), 1)
+
+        self.assertEqual("a", entry.username)
+        self.assertEqual(["b", None], [entry and entry.username for entry in entries])
+
+    async def test_stream_backpressure(self):
+        await self.db.insert_entries(User(username=str(i)) for i in range(100))
+
+        fetched = []
+        self.db.db.hooks.append(lambda event: fetched.append(event.rows))
+
+        entries = self.db.get_entries(User, arraysize=10)
+        self.assertEqual("0", (await anext(entries)).username)
+        await entries.aclose()
+        self.assertEqual([10], fetched)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,300 @@
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import islice
+from typing import Callable, Dict, List, Any, Tuple, Iterator, Iterable, Type
+
+import sql_lib
+import sqlite_lib
+from sqlite_lib import DBManager, Table, Entry, Date, INTEGER, TEXT, REAL, DATE, SQLParams
+
+SEED = 1970
+BATCH = 1000
+
+
+class User(Entry):
+    id = INTEGER() + SQLParams.PRIMARY_KEY
+    username = TEXT() + SQLParams.INDEX
+    score = REAL()
+    created_at = DATE()
+
+
+class LegacyUser(sql_lib.Entry):
+    id = sql_lib.INT() + sql_lib.SQLParams.PRIMARY_KEY
+    username = sql_lib.INT()
+    score = sql_lib.DOUBLE(10, 5)
+
+
+def entry_class(name: str) -> Type[Entry]:
+    return type(name, (Entry,), {"id": INTEGER() + SQLParams.PRIMARY_KEY, "username": TEXT() + SQLParams.INDEX,
+                                 "score": REAL(), "created_at": DATE()})
+
+
+def users(count: int) -> List[User]:
+    rng = random.Random(SEED)
+    return [User(username=f"user{i}", score=rng.random(), created_at=Date(2000 + i % 20, 1 + i % 12, 1 + i % 28))
+            for i in range(count)]
+
+
+def score(entry: User) -> float:
+    return sum(entry.score ** i for i in range(50))
+
+
+def batches(items: Iterable[Any], size: int = BATCH) -> Iterator[int]:
+    items = iter(items)
+    while count := sum(1 for _ in islice(items, size)):
+        yield count
+
+
+class Benchmark:
+    def __init__(self, name: str, run: Callable[[Any], Iterable[int]], setup: Callable[[], Any] = lambda: None,
+                 teardown: Callable[[Any], None] = lambda state: None, repeat: int = 5):
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.teardown = teardown
+        self.repeat = repeat
+
+    def measure(self) -> Dict[str, float]:
+        latencies, elapsed, ops, total = [], 0., 0, 0
+        for _ in range(self.repeat):
+            state = self.setup()
+            gc.collect()
+            ops = 0
+            started = last = time.perf_counter()
+            for count in self.run(state):
+                now = time.perf_counter()
+                latencies.append((now - last) / count)
+                last, ops = now, ops + count
+            elapsed += last - started
+            total += ops
+            self.teardown(state)
+
+        state = self.setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            for _ in self.run(state):
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            self.teardown(state)
+
+        latencies.sort()
+        return {
+            "ops": ops,
+            "ops_per_sec": total / elapsed,
+            "p50": percentile(latencies, .50),
+            "p95": percentile(latencies, .95),
+            "p99": percentile(latencies, .99),
+            "peak_memory": peak,
+        }
+
+
+def percentile(samples: List[float], q: float) -> float:
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class Database:
+    def __init__(self, rows: int = 0, tables: int = 0):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "bench.db")
+        self.tables = [Table("users", User)] + [Table(f"table{i}", entry_class(f"Table{i}")) for i in range(tables)]
+        self.entries = users(rows)
+        if rows:
+            with self.open() as db:
+                db.insert_entries(self.entries)
+
+    def open(self, **kwargs) -> DBManager:
+        return DBManager(self.path, tables=self.tables, **kwargs)
+
+    def close(self):
+        self.directory.cleanup()
+
+
+def entry_benchmarks(count: int) -> List[Benchmark]:
+    batch = min(count, BATCH)
+
+    def construct(_):
+        for _ in range(count // batch):
+            for _ in range(batch):
+                User(username="user", score=1., created_at=Date())
+            yield batch
+
+    def construct_legacy(_):
+        for _ in range(count // batch):
+            for i in range(batch):
+                LegacyUser(username=i, score=1.)
+            yield batch
+
+    def access(entry):
+        for _ in range(count // batch):
+            for _ in range(batch):
+                entry.username, entry.score
+                entry.score = 2.
+            yield batch
+
+    return [
+        Benchmark("entry.construct", construct),
+        Benchmark("entry.construct[sql_lib]", construct_legacy),
+        Benchmark("entry.access", access, setup=lambda: User(username="user")),
+        Benchmark("entry.access[sql_lib]", access, setup=lambda: LegacyUser(username=1)),
+    ]
+
+
+def date_benchmarks(count: int) -> List[Benchmark]:
+    batch = min(count, BATCH)
+
+    def construct(module):
+        for start in range(0, count - batch + 1, batch):
+            for i in range(start, start + batch):
+                module.Date(2000 + i % 20, 1 + i % 12, 1 + i % 28, i % 24, i % 60, i % 60)
+            yield batch
+
+    def format(dates):
+        return batches(map(str, dates))
+
+    return [
+        Benchmark("date.construct", construct, setup=lambda: sqlite_lib),
+        Benchmark("date.construct[sql_lib]", construct, setup=lambda: sql_lib),
+        Benchmark("date.format", format, setup=lambda: [Date(2000, 1 + i % 12, 1 + i % 28) for i in range(count)]),
+        Benchmark("date.format[sql_lib]", format,
+                  setup=lambda: [sql_lib.Date(2000, 1 + i % 12, 1 + i % 28) for i in range(count)]),
+    ]
+
+
+def insert_benchmarks(sizes: List[int]) -> List[Benchmark]:
+    def insert(state: Tuple[Database, DBManager]):
+        database, db = state
+        entries = iter(database.entries)
+        while chunk := [*islice(entries, db.chunk_size)]:
+            yield db.insert_entries(chunk)
+
+    def setup(size):
+        database = Database()
+        database.entries = users(size)
+        return database, database.open()
+
+    def teardown(state: Tuple[Database, DBManager]):
+        state[1].close()
+        state[0].close()
+
+    return [Benchmark(f"insert_entries[{size}]", insert, setup=lambda size=size: setup(size), teardown=teardown,
+                      repeat=3 if size < 1000000 else 1)
+            for size in sizes]
+
+
+def scan_benchmarks(sizes: List[int]) -> List[Benchmark]:
+    def scan(state: Tuple[Database, DBManager]):
+        return batches(state[1].get_entries(User))
+
+    def scan_lazy(state: Tuple[Database, DBManager]):
+        return batches(state[1].get_entries(User, lazy=True))
+
+    def filtered(state: Tuple[Database, DBManager]):
+        database, db = state
+        for i in range(1000):
+            [*db.select(User).where(User.username == f"user{i * 7 % len(database.entries)}")]
+            yield 1
+
+    def serial(state: Tuple[Database, DBManager]):
+        return batches(map(score, state[1].get_entries(User)))
+
+    def parallel(state: Tuple[Database, DBManager]):
+        return batches(state[1].parallel_map(User, score, workers=os.cpu_count()))
+
+    databases: Dict[int, Tuple[Database, DBManager]] = {}
+
+    def setup(size):
+        if size not in databases:
+            database = Database(rows=size)
+            databases[size] = database, database.open()
+        return databases[size]
+
+    benchmarks = []
+    for size in sizes:
+        benchmarks += [
+            Benchmark(f"get_entries[{size}]", scan, setup=lambda size=size: setup(size), repeat=3),
+            Benchmark(f"get_entries.lazy[{size}]", scan_lazy, setup=lambda size=size: setup(size), repeat=3),
+            Benchmark(f"select.filtered[{size}]", filtered, setup=lambda size=size: setup(size), repeat=3),
+            Benchmark(f"scan.serial[{size}]", serial, setup=lambda size=size: setup(size), repeat=3),
+            Benchmark(f"scan.parallel_map[{size}]", parallel, setup=lambda size=size: setup(size), repeat=3),
+        ]
+    return benchmarks
+
+
+def startup_benchmarks(tables: int) -> List[Benchmark]:
+    def startup(database: Database):
+        for _ in range(10):
+            database.open().close()
+            yield 1
+
+    def setup():
+        database = Database(tables=tables)
+        database.open().close()
+        return database
+
+    return [Benchmark(f"startup[{tables} tables]", startup, setup=setup, teardown=Database.close)]
+
+
+def benchmarks(sizes: List[int], count: int, tables: int) -> List[Benchmark]:
+    return [*entry_benchmarks(count), *date_benchmarks(count), *insert_benchmarks(sizes), *scan_benchmarks(sizes),
+            *startup_benchmarks(tables)]
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            threshold: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result["ops_per_sec"] / baseline[name]["ops_per_sec"] - 1
+        if change < -threshold:
+            regressions.append(f"{name}: {change:+.1%} ops/sec")
+    return regressions
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark sqlite_lib and sql_lib")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--count", type=int, default=100000, help="operations for micro benchmarks")
+    parser.add_argument("--tables", type=int, default=50, help="tables for the startup benchmark")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results against this JSON baseline")
+    parser.add_argument("--threshold", type=float, default=.1, help="allowed ops/sec regression (0.1 = 10%%)")
+    args = parser.parse_args(argv)
+
+    sqlite_lib.logger.remove()
+
+    results = {}
+    for benchmark in benchmarks(args.sizes, args.count, args.tables):
+        if args.filter not in benchmark.name:
+            continue
+        result = results[benchmark.name] = benchmark.measure()
+        print(f"{benchmark.name:<32} {result['ops_per_sec']:>14,.0f} ops/s  "
+              f"p50 {result['p50'] * 1e6:>9.3f} us  p99 {result['p99'] * 1e6:>9.3f} us  "
+              f"peak {result['peak_memory'] / 2 ** 20:>8.2f} MiB")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
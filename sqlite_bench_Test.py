@@ -0,0 +1,30 @@
+import unittest
+import sqlite_bench
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_measure(self):
+        result = sqlite_bench.Benchmark("noop", lambda state: sqlite_bench.batches(state, 30),
+                                        setup=lambda: [0] * 100).measure()
+
+        self.assertEqual(100, result["ops"])
+        self.assertGreater(result["ops_per_sec"], 0)
+        self.assertLessEqual(result["p50"], result["p99"])
+        self.assertGreaterEqual(result["peak_memory"], 0)
+
+    def test_distinct_tables(self):
+        database = sqlite_bench.Database(tables=3)
+        self.addCleanup(database.close)
+        with database.open() as db:
+            self.assertEqual(4, len(db.tables))
+
+    def test_compare(self):
+        baseline = {"a": {"ops_per_sec": 100.}, "b": {"ops_per_sec": 100.}}
+        results = {"a": {"ops_per_sec": 95.}, "b": {"ops_per_sec": 80.}, "c": {"ops_per_sec": 1.}}
+
+        self.assertEqual(["b: -20.0% ops/sec"], sqlite_bench.compare(results, baseline, .1))
+        self.assertEqual([], sqlite_bench.compare(results, baseline, .25))
+
+
+if __name__ == '__main__':
+    unittest.main()
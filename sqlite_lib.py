@@ -1,11 +1,43 @@
+import base64
+import calendar
+import csv
+import functools
+import hashlib
+import json
+import os
+import pickle
+import queue
+import random
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
 from enum import Enum
+from itertools import islice
+from pathlib import Path
 
 from loguru import logger
 import sqlite3
-from typing import Generator, List, Any, Type, Dict
+from typing import Generator, List, Any, Type, Dict, Iterable, Union, Tuple, Callable, Optional
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_DAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def _is_leap(year: int) -> bool:
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
 
 
 class Date:
+    __slots__ = ("year", "month", "day", "hour", "minute", "second")
+
     def __init__(self, year=1970, month=1, day=1, hour=0, minute=0, second=0):
         self.year = year
         self.month = month
@@ -13,37 +45,116 @@ class Date:
         self.hour = hour
         self.minute = minute
         self.second = second
+        self.__validate__()
+
+    @classmethod
+    def _new(cls, year, month, day, hour=0, minute=0, second=0):
+        date = object.__new__(cls)
+        date.year, date.month, date.day, date.hour, date.minute, date.second = year, month, day, hour, minute, second
+        return date
 
-        if [*self.__check_vals__()]:
-            raise ValueError
+    @staticmethod
+    def fromstr(string, format=None):
+        if format is not None:
+            parsed = datetime.strptime(string, format)
+            return Date(parsed.year, parsed.month, parsed.day, parsed.hour, parsed.minute, parsed.second)
+
+        if len(string) < 19:
+            return Date(int(string[0:4]), int(string[5:7]), int(string[8:10]))
+        return Date(int(string[0:4]), int(string[5:7]), int(string[8:10]),
+                    int(string[11:13]), int(string[14:16]), int(string[17:19]))
+
+    @staticmethod
+    def fromstrs(strings: Iterable[Union[str, bytes, None]]) -> List["Date"]:
+        new = Date._new
+        dates = [None if string is None else
+                 new(int(string[0:4]), int(string[5:7]), int(string[8:10])) if len(string) < 19 else
+                 new(int(string[0:4]), int(string[5:7]), int(string[8:10]),
+                     int(string[11:13]), int(string[14:16]), int(string[17:19]))
+                 for string in strings]
+        for date in dates:
+            if date is not None:
+                date.__validate__()
+        return dates
+
+    @staticmethod
+    def frombytes(string: bytes) -> "Date":
+        return Date.fromstrs((string,))[0]
+
+    @staticmethod
+    def fromepoch(seconds: int) -> "Date":
+        parsed = time.gmtime(int(seconds))
+        return Date._new(parsed.tm_year, parsed.tm_mon, parsed.tm_mday, parsed.tm_hour, parsed.tm_min, parsed.tm_sec)
 
     @staticmethod
-    def fromstr(string, format):
-        raise NotImplemented
+    def fromepochs(values: Iterable[Union[int, bytes, None]]) -> List["Date"]:
+        new, gmtime = Date._new, time.gmtime
+        return [None if value is None else new(*gmtime(int(value))[:6]) for value in values]
+
+    def epoch(self) -> int:
+        return calendar.timegm((self.year, self.month, self.day, self.hour, self.minute, self.second))
+
+    def isoformat(self):
+        return f"{self.year}-{self.month:0>2}-{self.day:0>2} {self.hour:0>2}:{self.minute:0>2}:{self.second:0>2}"
 
     def __str__(self):
-        return f"\'{self.year}-{self.month:0>2}-{self.day:0>2} {self.hour:0>2}:{self.minute:0>2}:{self.second:0>2}\'"
+        return f"\'{self.isoformat()}\'"
+
+    def __repr__(self):
+        return f"Date({self.year}, {self.month}, {self.day}, {self.hour}, {self.minute}, {self.second})"
+
+    def __key__(self):
+        return self.year, self.month, self.day, self.hour, self.minute, self.second
+
+    def __eq__(self, other):
+        return type(other) is Date and self.__key__() == other.__key__()
+
+    def __lt__(self, other):
+        return self.__key__() < other.__key__()
+
+    def __hash__(self):
+        return hash(self.__key__())
+
+    def __validate__(self):
+        if not (1000 <= self.year <= 9999 and 1 <= self.month <= 12 and self.__check_day__() and
+                0 <= self.hour <= 23 and 0 <= self.minute <= 59 and 0 <= self.second <= 59):
+            raise ValueError(f"Invalid {', '.join(self.__check_vals__())}")
 
     def __check_day__(self) -> bool:
         if self.month == 2:
-            return 1 <= self.day <= (28 if self.year % 4 else 29)
-        elif self.month in (1, 3, 5, 7, 8, 10, 12):
-            return 1 <= self.day <= 31
-        else:
-            return 1 <= self.day <= 30
+            return 1 <= self.day <= (29 if _is_leap(self.year) else 28)
+        return 1 <= self.day <= _DAYS[self.month - 1]
 
     def __check_vals__(self) -> Generator[str, None, None]:
-        vals = {
-            not 1000 <= self.year <= 9999: "year",
-            not 1 <= self.month <= 12: "month",
-            not self.__check_day__(): "day",
-            not 0 <= self.hour <= 23: "hour",
-            not 0 <= self.minute <= 59: "minute",
-            not 0 <= self.second <= 59: "second"
-        }
-
-        for _, val in filter(lambda x: x[0], vals.items()):
-            yield val
+        if not 1000 <= self.year <= 9999:
+            yield "year"
+        if not 1 <= self.month <= 12:
+            yield "month"
+        elif not self.__check_day__():
+            yield "day"
+        if not 0 <= self.hour <= 23:
+            yield "hour"
+        if not 0 <= self.minute <= 59:
+            yield "minute"
+        if not 0 <= self.second <= 59:
+            yield "second"
+
+
+sqlite3.register_adapter(Date, Date.isoformat)
+sqlite3.register_converter("sqlite_lib_date", Date.frombytes)
+sqlite3.register_converter("sqlite_lib_epoch", Date.fromepoch)
+
+
+def _literal(val):
+    if val is None:
+        return "NULL"
+    if type(val) is bool:
+        return "1" if val else "0"
+    if type(val) in (int, float):
+        return str(val)
+    if type(val) is Date:
+        val = val.isoformat()
+    return "'" + str(val).replace("'", "''") + "'"
 
 
 class SQLParams(Enum):
@@ -52,6 +163,8 @@ class SQLParams(Enum):
     PRIMARY_KEY = "PRIMARY KEY"
     FOREIGN_KEY = "FOREIGN KEY"
     AUTOINCREMENT = "AUTOINCREMENT"
+    INDEX = "INDEX"
+    UNIQUE = "UNIQUE"
 
     def __str__(self):
         return self.value
@@ -63,6 +176,7 @@ class SQLTypes(Enum):
     BOOLEAN = "BOOLEAN", bool
     REAL = "REAL", float
     DATE = "TEXT", Date
+    EPOCH = "INTEGER", Date
 
     def sql_type(self):
         return str(self)
@@ -70,15 +184,182 @@ class SQLTypes(Enum):
     def py_type(self):
         return self.value[1]
 
+    def numpy_type(self):
+        if self.value[1] is Date:
+            return "datetime64[s]"
+        return {int: "int64", float: "float64", bool: "bool"}.get(self.value[1], "object")
+
     def __str__(self):
         return self.value[0]
 
 
-class Field:
+class Expression:
+    def __sql__(self, params: List[Any]) -> str:
+        raise NotImplementedError
+
+    def __select__(self, params: List[Any]) -> str:
+        return self.__sql__(params)
+
+    def adapt(self, value):
+        return value
+
+    def __eq__(self, other):
+        return Condition("{} IS NULL", self) if other is None else Condition("{} = {}", self, other)
+
+    def __ne__(self, other):
+        return Condition("{} IS NOT NULL", self) if other is None else Condition("{} != {}", self, other)
+
+    def __lt__(self, other):
+        return Condition("{} < {}", self, other)
+
+    def __le__(self, other):
+        return Condition("{} <= {}", self, other)
+
+    def __gt__(self, other):
+        return Condition("{} > {}", self, other)
+
+    def __ge__(self, other):
+        return Condition("{} >= {}", self, other)
+
+    __hash__ = object.__hash__
+
+    def in_(self, values: Iterable[Any]):
+        values = [*values]
+        if not values:
+            return Condition("0")
+        return Condition(f"{{}} IN ({', '.join('{}' for _ in values)})", self, *values)
+
+    def not_in(self, values: Iterable[Any]):
+        return ~self.in_(values)
+
+    def like(self, pattern: str):
+        return Condition("{} LIKE {}", self, pattern)
+
+    def between(self, low, high):
+        return Condition("{} BETWEEN {} AND {}", self, low, high)
+
+    def is_null(self):
+        return Condition("{} IS NULL", self)
+
+    def asc(self):
+        return Ordering(self)
+
+    def desc(self):
+        return Ordering(self, descending=True)
+
+
+def _operand(operand, params: List[Any], adapt: Callable[[Any], Any]) -> str:
+    if isinstance(operand, Expression):
+        return operand.__sql__(params)
+    params.append(adapt(operand))
+    return "?"
+
+
+class Condition(Expression):
+    def __init__(self, template: str, *operands):
+        self.template = template
+        self.operands = operands
+
+    def __sql__(self, params: List[Any]) -> str:
+        adapt = self.operands[0].adapt if self.operands else None
+        return self.template.format(*(_operand(operand, params, adapt) for operand in self.operands))
+
+    def __and__(self, other):
+        return Condition("({} AND {})", self, other)
+
+    def __or__(self, other):
+        return Condition("({} OR {})", self, other)
+
+    def __invert__(self):
+        return Condition("NOT {}", self)
+
+    def __bool__(self):
+        raise TypeError("Conditions can't be used as booleans, combine them with & and |")
+
+
+class Ordering:
+    def __init__(self, expression: Expression, descending=False):
+        self.expression = expression
+        self.descending = descending
+
+    def __sql__(self, params: List[Any]) -> str:
+        return f"{self.expression.__sql__(params)}{' DESC' if self.descending else ''}"
+
+
+class Function(Expression):
+    def __init__(self, name: str, template: str, *operands):
+        self.name = name
+        self.template = template
+        self.operands = operands
+
+    def __sql__(self, params: List[Any]) -> str:
+        adapt = self.operands[0].adapt if self.operands else None
+        return self.template.format(*(_operand(operand, params, adapt) for operand in self.operands))
+
+    def alias(self, name: str):
+        self.name = name
+        return self
+
+
+class DateTrunc(Function):
+    UNITS = {"day": (), "month": ("start of month",), "year": ("start of year",)}
+
+    def __init__(self, field: "DATE", unit: str):
+        modifiers = ("unixepoch",) * (field.type is SQLTypes.EPOCH) + self.UNITS[unit]
+        super().__init__(f"{field.name}_{unit}", f"date({{}}{''.join(f', {_literal(m)}' for m in modifiers)})", field)
+
+    def __select__(self, params: List[Any]) -> str:
+        return f'{self.__sql__(params)} AS "{self.name} [sqlite_lib_date]"'
+
+
+def count(expression: Expression = None, distinct=False) -> Function:
+    if expression is None:
+        return Function("count", "COUNT(*)")
+    return Function(f"count_{expression.name}", f"COUNT({'DISTINCT ' if distinct else ''}{{}})", expression)
+
+
+def sum_(expression: Expression) -> Function:
+    return Function(f"sum_{expression.name}", "SUM({})", expression)
+
+
+def avg(expression: Expression) -> Function:
+    return Function(f"avg_{expression.name}", "AVG({})", expression)
+
+
+def min_(expression: Expression) -> Function:
+    return Function(f"min_{expression.name}", "MIN({})", expression)
+
+
+def max_(expression: Expression) -> Function:
+    return Function(f"max_{expression.name}", "MAX({})", expression)
+
+
+class Field(Expression):
     def __init__(self, type: SQLTypes):
         self.__value = type.py_type()()
         self.type = type
         self.params: List[SQLParams] = []
+        self.name: str = None
+        self.index: int = None
+        self.mask = 0
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return instance._values[self.index]
+
+    def __sql__(self, params: List[Any]) -> str:
+        return self.name
+
+    def __set__(self, instance, value):
+        values = instance._values
+        if type(values) is tuple:
+            instance._values = values = [*values]
+        values[self.index] = value
+        try:
+            instance._dirty |= self.mask
+        except AttributeError:
+            instance._dirty = self.mask
 
     def __add__(self, other):
         if other.name not in SQLParams.__members__:
@@ -88,7 +369,8 @@ class Field:
         return self
 
     def __str__(self):
-        params = " " + " ".join(map(str, self.params)) if self.params else ""
+        params = [*filter(lambda x: x not in (SQLParams.INDEX, SQLParams.UNIQUE, SQLParams.FOREIGN_KEY), self.params)]
+        params = " " + " ".join(map(str, params)) if params else ""
         return f"{self.type.sql_type()}{params}"
 
     def __verify_type__(self, val):
@@ -96,9 +378,27 @@ class Field:
             return True
         return False
 
+    def __ddl__(self, titles: Dict[Type["Entry"], str]) -> str:
+        return str(self)
+
     def is_primary_key(self):
         return SQLParams.PRIMARY_KEY in self.params
 
+    def coerce(self, value):
+        py_type = self.type.py_type()
+        if value is None or value == "" and py_type is not str:
+            return None
+        if type(value) is py_type:
+            return self.adapt(value)
+        if py_type is Date:
+            return self.adapt(Date.fromstr(value))
+        if py_type is bool and type(value) is str:
+            return value.lower() in ("1", "true", "yes")
+        return py_type(value)
+
+    def is_indexed(self):
+        return SQLParams.INDEX in self.params or SQLParams.UNIQUE in self.params
+
     def def_value(self):
         return self.__value
 
@@ -119,8 +419,36 @@ class TEXT(Field):
 
 
 class DATE(Field):
-    def __init__(self):
-        super().__init__(SQLTypes.DATE)
+    def __init__(self, storage: str = "text"):
+        if storage not in ("text", "epoch"):
+            raise ValueError(f"Unknown date storage: {storage}")
+        super().__init__(SQLTypes.EPOCH if storage == "epoch" else SQLTypes.DATE)
+
+    def adapt(self, value):
+        if self.type is SQLTypes.EPOCH and type(value) is Date:
+            return value.epoch()
+        return value
+
+    def coerce(self, value):
+        if self.type is SQLTypes.EPOCH and (type(value) in (int, float) or
+                                            type(value) is str and value.strip().lstrip("-").isdigit()):
+            return self.adapt(Date.fromepoch(value))
+        return super().coerce(value)
+
+    def __select__(self, params: List[Any]) -> str:
+        return f'{self.name} AS "{self.name} [sqlite_lib_{"epoch" if self.type is SQLTypes.EPOCH else "date"}]"'
+
+    @property
+    def day(self) -> DateTrunc:
+        return DateTrunc(self, "day")
+
+    @property
+    def month(self) -> DateTrunc:
+        return DateTrunc(self, "month")
+
+    @property
+    def year(self) -> DateTrunc:
+        return DateTrunc(self, "year")
 
 
 def d(v):
@@ -128,76 +456,215 @@ def d(v):
     return v
 
 
-class Entry:
-    def __init__(self, **kwargs):
-        self.__values = {}
+class REFERENCE(Field):
+    def __init__(self, target: Type["Entry"], table: str = None, on_delete: str = None):
+        schema = target.__schema__
+        if schema.pk_name is None:
+            raise ValueError(f"{target.__name__} has no primary key to reference")
+        super().__init__(schema.fields[schema.pk_name].type)
+        self.params.append(SQLParams.FOREIGN_KEY)
+        self.target = target
+        self.table = table
+        self.on_delete = on_delete
+
+    def __set__(self, instance, value):
+        super().__set__(instance, value.get_key() if isinstance(value, Entry) else value)
 
-        fields = self.__get_fields__()
+    def def_value(self):
+        return None
 
-        _kwargs = dict()
+    def __ddl__(self, titles: Dict[Type["Entry"], str]) -> str:
+        table = self.table or titles.get(self.target)
+        if table is None:
+            raise ValueError(f"No table registered for {self.target.__name__}")
 
-        for key, val in fields.items():
-            _kwargs[key] = kwargs[key] if key in kwargs else val.def_value()
+        sql = f"{self} REFERENCES {table} ({self.target.__schema__.pk_name})"
+        return f"{sql} ON DELETE {self.on_delete}" if self.on_delete else sql
 
-        kwargs = _kwargs
 
-        for key, value in kwargs.items():
-            if key in fields:
-                if type(value) is fields[key].type.py_type():
-                    self.__values[key] = value
+class Index:
+    def __init__(self, *columns: Union[Expression, Ordering], unique=False, where: Union[Condition, str] = None,
+                 include: Iterable[Expression] = ()):
+        self.columns = columns
+        self.unique = unique
+        self.where = where
+        self.include = tuple(include)
+        self.name: str = None
 
-    def set_vals(self, *args, primary_key=False):
-        fields = self.__get_fields__()
+    def create(self, table: str) -> str:
+        columns = ", ".join(column.__sql__([]) for column in (*self.columns, *self.include))
+        sql = f"CREATE {'UNIQUE ' if self.unique else ''}INDEX IF NOT EXISTS {table}_{self.name} ON {table} ({columns})"
+
+        if isinstance(self.where, Condition):
+            params = []
+            head, *parts = self.where.__sql__(params).split("?")
+            sql += " WHERE " + head + "".join(map(lambda x: _literal(x[0]) + x[1], zip(params, parts)))
+        elif self.where is not None:
+            sql += f" WHERE {self.where}"
+
+        return sql
+
+    def drop(self, table: str) -> str:
+        return f"DROP INDEX IF EXISTS {table}_{self.name}"
+
+
+class Schema:
+    def __init__(self, fields: Dict[str, Field], indexes: Dict[str, Index]):
+        self.fields = fields
+        self.indexes = indexes
+        self.names = tuple(fields)
+        self.types = tuple(field.type.py_type() for field in fields.values())
+        self.defaults = tuple(field.def_value() for field in fields.values())
+        self.primary_key = tuple(field.is_primary_key() for field in fields.values())
+        self.insert_indexes = tuple(index for index, pk in enumerate(self.primary_key) if not pk)
+        self.pk_index = self.primary_key.index(True) if any(self.primary_key) else None
+        self.pk_name = None if self.pk_index is None else self.names[self.pk_index]
+        self.references = tuple(name for name, field in fields.items() if isinstance(field, REFERENCE))
+        self.select_expressions = tuple(field.__select__([]) for field in fields.values())
+        self.adapters = tuple((index, field.adapt) for index, field in enumerate(fields.values())
+                              if field.type is SQLTypes.EPOCH)
+        self.insert_adapters = tuple((self.insert_indexes.index(index), adapt) for index, adapt in self.adapters
+                                     if index in self.insert_indexes)
+        self.select_columns = ", ".join(self.names)
+        self.insert_columns = ", ".join(self.names[index] for index in self.insert_indexes)
 
-        for key, val in zip(filter(lambda x: not fields[x].is_primary_key() or primary_key, self.__values.keys()),
-                            args):
-            self.__values[key] = val
+
+_UNSAVED = 1 << 63
+
+
+class EntryMeta(type):
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault("__slots__", ())
+        cls = super().__new__(mcs, name, bases, namespace)
+
+        fields, indexes = {}, {}
+        for klass in reversed(cls.__mro__):
+            fields.update((key, val) for key, val in vars(klass).items() if isinstance(val, Field))
+            indexes.update((key, val) for key, val in vars(klass).items() if isinstance(val, Index))
+
+        for index, (key, field) in enumerate(fields.items()):
+            field.name = key
+            field.index = index
+            field.mask = 1 << index
+
+            if field.is_indexed() and f"{key}_idx" not in indexes:
+                indexes[f"{key}_idx"] = Index(field, unique=SQLParams.UNIQUE in field.params)
+
+        for key, index in indexes.items():
+            index.name = key
+
+        cls.__schema__ = Schema(fields, indexes)
+        return cls
+
+
+class Entry(metaclass=EntryMeta):
+    __slots__ = ("_values", "_related", "_dirty")
+    __schema__: Schema
+
+    def __init__(self, **kwargs):
+        schema = self.__schema__
+        values = [*schema.defaults]
+
+        if kwargs:
+            for key in schema.references:
+                if isinstance(kwargs.get(key), Entry):
+                    kwargs[key] = kwargs[key].get_key()
+            for index, key in enumerate(schema.names):
+                if key in kwargs and type(kwargs[key]) is schema.types[index]:
+                    values[index] = kwargs[key]
+
+        self._values = values
+        self._dirty = self.__unsaved()
+
+    def __unsaved(self) -> int:
+        schema = self.__schema__
+        pk_index = schema.pk_index
+        return 0 if pk_index is not None and self._values[pk_index] != schema.defaults[pk_index] else _UNSAVED
+
+    @classmethod
+    def from_row(cls, row, lazy=False):
+        entry = cls.__new__(cls)
+        entry._values = row if lazy else [*row]
+        return entry
+
+    def set_vals(self, *args, primary_key=False):
+        values = self._values
+        if type(values) is tuple:
+            self._values = values = [*values]
+        indexes = range(len(values)) if primary_key else self.__schema__.insert_indexes
+
+        for index, val in zip(indexes, args):
+            values[index] = val
+        if primary_key:
+            self._dirty = getattr(self, "_dirty", 0) & ~_UNSAVED | self.__unsaved()
         return self
 
     def get_vals(self, primary_key=False):
-        return [*map(lambda y: y[1], filter(lambda x: not self.__get_fields__()[x[0]].is_primary_key() or primary_key,
-                                            self.__values.items()))]
+        values = self._values
+        if primary_key:
+            return [*values]
+        return [values[index] for index in self.__schema__.insert_indexes]
+
+    def get_key(self):
+        return self._values[self.__schema__.pk_index]
+
+    def dirty_fields(self) -> Tuple[str, ...]:
+        dirty = getattr(self, "_dirty", 0)
+        return tuple(name for index, name in enumerate(self.__schema__.names) if dirty >> index & 1)
+
+    def is_dirty(self) -> bool:
+        return getattr(self, "_dirty", 0) & ~_UNSAVED != 0
+
+    def is_saved(self) -> bool:
+        return not getattr(self, "_dirty", 0) & _UNSAVED
+
+    def mark_clean(self, columns: Iterable[str] = None):
+        if columns is None:
+            self._dirty = 0
+        else:
+            fields = self.__schema__.fields
+            self._dirty = getattr(self, "_dirty", 0) & ~functools.reduce(
+                lambda mask, name: mask | fields[name].mask, columns, _UNSAVED)
+        return self
 
-    def get_fields_on_select(self):
-        return self.get_fields_on_insert(primary_key=True)
+    def related(self, field: REFERENCE):
+        related = getattr(self, "_related", None)
+        if related is None or field.name not in related:
+            raise KeyError(f"{field.name} was not prefetched")
+        return related[field.name]
 
-    def get_fields_on_insert(self, primary_key=False):
-        return ", ".join(
-            f"{key}" for key, _ in filter(lambda x: not x[1].is_primary_key() or primary_key,
-                                          self.__get_fields__().items()))
+    def get_params(self, primary_key=False, columns: Tuple[str, ...] = None):
+        if columns:
+            fields = self.__schema__.fields
+            return [fields[column].adapt(self._values[fields[column].index]) for column in columns]
+
+        values = self.get_vals(primary_key)
+        for index, adapt in self.__schema__.adapters if primary_key else self.__schema__.insert_adapters:
+            values[index] = adapt(values[index])
+        return values
 
     @classmethod
-    def get_fields_on_create(cls):
-        def args(val):
-            return f"({', '.join(map(str, val.args))})" if val.args else ""
+    def get_fields_on_select(cls):
+        return cls.__schema__.select_columns
 
-        return ",\n".join(f"{key} {str(val)}" for key, val in cls.__get_fields__().items())
+    @classmethod
+    def get_fields_on_insert(cls, primary_key=False):
+        return cls.__schema__.select_columns if primary_key else cls.__schema__.insert_columns
+
+    @classmethod
+    def get_fields_on_create(cls):
+        return ",\n".join(f"{key} {str(val)}" for key, val in cls.__schema__.fields.items())
 
     @classmethod
     def __get_fields__(cls) -> Dict[str, Field]:
-        return {key: val for key, val in
-                filter(lambda x: issubclass(type(x[1]), Field), cls.__dict__.items())}
+        return cls.__schema__.fields
 
     def __iter__(self):
-        return self.__values
+        return iter(self._values)
 
     def __str__(self):
         return ", ".join(map(lambda x: str(x), self.get_vals()))
 
-    def __setattr__(self, key, value):
-        if key in self.__get_fields__():
-            self.__values[key] = value
-        else:
-            super().__setattr__(key, value)
-
-    def __getattribute__(self, item):
-        if item in ["__dict__", "__get_fields__", "__values", "__class__"]:
-            return super().__getattribute__(item)
-
-        if item in self.__get_fields__():
-            return self.__values[item]
-        return super().__getattribute__(item)
-
 
 class DataEntry:
     def __init__(self, **kwargs):
@@ -262,68 +729,1357 @@ class DataEntry:
 
 
 class Table:
-    def __init__(self, title, entry: Type[Entry]):
+    def __init__(self, title, entry: Type[Entry], cache_size: int = 0, cache_ttl: float = None):
         self.title = title
         self.__entry = entry
+        self.__statements: Dict[Tuple[str, bool, Tuple[str, ...], int], str] = {}
+        self.hits = 0
+        self.misses = 0
+        self.cache = EntryCache(cache_size, cache_ttl) if cache_size else None
+        self.titles: Dict[Type[Entry], str] = {entry: title}
 
-    def entry(self, *args):
-        return self.__entry().set_vals(*args)
+    def entry(self, *args, primary_key=False):
+        entry = self.__entry().set_vals(*args, primary_key=primary_key)
+        return entry.mark_clean() if primary_key else entry
 
     def entry_class(self):
         return self.__entry
 
+    def bind(self, titles: Dict[Type[Entry], str]):
+        if titles != self.titles:
+            self.titles = titles
+            self.__statements.clear()
+        return self
+
+    def row_factory(self, lazy=False):
+        cls, new = self.__entry, object.__new__
+
+        if lazy:
+            def factory(_, row):
+                entry = new(cls)
+                entry._values = row
+                return entry
+        else:
+            def factory(_, row):
+                entry = new(cls)
+                entry._values = [*row]
+                return entry
+
+        return factory
+
+    def statement(self, kind: str, primary_key=False, columns: Tuple[str, ...] = None, count: int = 1) -> str:
+        key = kind, primary_key, columns, count
+        sql = self.__statements.get(key)
+
+        if sql is None:
+            self.misses += 1
+            sql = self.__statements[key] = self.__compile(kind, primary_key, columns, count)
+        else:
+            self.hits += 1
+        return sql
+
+    def statement_stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.__statements)}
+
+    def __compile(self, kind: str, primary_key: bool, columns: Tuple[str, ...], count: int) -> str:
+        schema = self.__entry.__schema__
+        if columns is None and kind in ("select", "get"):
+            columns = schema.select_expressions
+        elif columns is None:
+            columns = schema.names if primary_key else tuple(schema.names[index] for index in schema.insert_indexes)
+
+        if kind == "create":
+            columns = ",\n".join(f"{name} {field.__ddl__(self.titles)}" for name, field in schema.fields.items())
+            return f"CREATE TABLE IF NOT EXISTS {self.title} ({columns})"
+        if kind == "insert":
+            if not columns:
+                return f"INSERT INTO {self.title} DEFAULT VALUES"
+            return f"INSERT INTO {self.title} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        if kind == "select":
+            return f"SELECT {', '.join(columns)} FROM {self.title}"
+
+        if schema.pk_name is None:
+            raise ValueError(f"{kind.upper()} by key needs a primary key on {self.__entry.__name__}")
+        if kind == "update":
+            return f"UPDATE {self.title} SET {', '.join(f'{column} = ?' for column in columns)} WHERE {schema.pk_name} = ?"
+        if kind == "upsert":
+            action = f"UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in columns)}" \
+                if columns else "NOTHING"
+            return f"INSERT INTO {self.title} ({', '.join(schema.names)}) VALUES ({', '.join('?' * len(schema.names))}) " \
+                   f"ON CONFLICT ({schema.pk_name}) DO {action}"
+        if kind == "delete":
+            return f"DELETE FROM {self.title} WHERE {schema.pk_name} = ?"
+        if kind == "get":
+            where = "= ?" if count == 1 else f"IN ({', '.join('?' * count)})"
+            return f"SELECT {', '.join(columns)} FROM {self.title} WHERE {schema.pk_name} {where}"
+        raise ValueError(f"Unknown statement kind: {kind}")
+
     def init(self):
-        return f"CREATE TABLE IF NOT EXISTS {self.title} ({self.__entry.get_fields_on_create()})"
+        return self.statement("create")
+
+    def migrate(self, columns: Iterable[str]) -> List[str]:
+        columns = set(columns)
+        if not columns:
+            return [self.init()]
+
+        statements = []
+        for name, field in self.__entry.__schema__.fields.items():
+            if name in columns:
+                continue
+            if SQLParams.PRIMARY_KEY in field.params:
+                raise ValueError(f"Can't add {self.title}.{name}: ALTER TABLE can't add PRIMARY KEY columns")
+
+            sql = f"ALTER TABLE {self.title} ADD COLUMN {name} {field.__ddl__(self.titles)}"
+            if SQLParams.NOT_NULL in field.params:
+                default = field.adapt(field.def_value())
+                if default is None:
+                    raise ValueError(f"Can't add NOT NULL column {self.title}.{name} without a default value")
+                sql += f" DEFAULT {_literal(default)}"
+            statements.append(sql)
+        return statements
+
+    def create_indexes(self) -> List[str]:
+        return [index.create(self.title) for index in self.__entry.__schema__.indexes.values()]
+
+    def drop_indexes(self) -> List[str]:
+        return [index.drop(self.title) for index in self.__entry.__schema__.indexes.values()]
 
     def insert_entry(self, entry: Entry, primary_key=False):
-        def _str(val):
-            if type(val) in (Date, int, float):
-                return str(val)
-            return "'" + str(val) + "'"
+        if not entry.get_fields_on_insert(primary_key=primary_key):
+            return f"INSERT INTO {self.title} DEFAULT VALUES"
+        return f"INSERT INTO {self.title} ({entry.get_fields_on_insert(primary_key=primary_key)}) VALUES ({', '.join(map(_literal, entry.get_vals(primary_key=primary_key)))})"
+
+    def insert_statement(self, primary_key=False):
+        return self.statement("insert", primary_key)
+
+    def update_statement(self, columns: Tuple[str, ...] = None):
+        return self.statement("update", columns=columns)
+
+    def delete_statement(self):
+        return self.statement("delete")
 
-        return f"INSERT INTO {self.title} ({entry.get_fields_on_insert(primary_key=primary_key)}) VALUES ({', '.join(map(_str, entry.get_vals(primary_key=primary_key)))})"
+    def upsert_statement(self, columns: Tuple[str, ...] = None):
+        return self.statement("upsert", columns=columns)
+
+    def get_statement(self, count: int = 1):
+        return self.statement("get", count=count)
+
+    def cache_stats(self) -> Dict[str, float]:
+        return self.cache.stats() if self.cache is not None else EntryCache(0).stats()
 
     def get_entries(self):
-        return f"SELECT * FROM {self.title}"
+        return self.statement("select")
+
+    def select(self, columns: Iterable[Expression] = (), where: Condition = None,
+               order_by: Iterable[Union[Expression, Ordering]] = (), limit: int = None, offset: int = None,
+               group_by: Iterable[Expression] = (), having: Condition = None):
+        params = []
+        columns = tuple(column.__select__(params) for column in columns) or None
+        sql = self.statement("select", columns=columns)
+
+        if where is not None:
+            sql += f" WHERE {where.__sql__(params)}"
+        if group_by:
+            sql += f" GROUP BY {', '.join(expression.__sql__(params) for expression in group_by)}"
+        if having is not None:
+            sql += f" HAVING {having.__sql__(params)}"
+        if order_by:
+            sql += f" ORDER BY {', '.join(order.__sql__(params) for order in order_by)}"
+        if limit is not None or offset is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += [-1 if limit is None else limit, offset or 0]
+
+        return sql, params
+
+
+class Select:
+    def __init__(self, db: "DBManager", entry_type: Type[Entry], *columns: Expression):
+        self.db = db
+        self.table = db.tables[entry_type]
+        self.__columns = columns
+        self.__where: Condition = None
+        self.__order_by: List[Union[Expression, Ordering]] = []
+        self.__limit: int = None
+        self.__offset: int = None
+        self.__group_by: List[Expression] = []
+        self.__having: Condition = None
+        self.__prefetch: List[REFERENCE] = []
+        self.__lazy = False
+
+    def columns(self, *columns: Expression):
+        self.__columns = columns
+        return self
+
+    def where(self, *conditions: Condition):
+        for condition in conditions:
+            self.__where = condition if self.__where is None else self.__where & condition
+        return self
+
+    def order_by(self, *order_by: Union[Expression, Ordering]):
+        self.__order_by += order_by
+        return self
+
+    def group_by(self, *group_by: Expression):
+        self.__group_by += group_by
+        return self
+
+    def having(self, *conditions: Condition):
+        for condition in conditions:
+            self.__having = condition if self.__having is None else self.__having & condition
+        return self
+
+    def limit(self, limit: int, offset: int = None):
+        self.__limit = limit
+        if offset is not None:
+            self.__offset = offset
+        return self
+
+    def offset(self, offset: int):
+        self.__offset = offset
+        return self
+
+    def lazy(self, lazy=True):
+        self.__lazy = lazy
+        return self
+
+    def prefetch(self, *fields: REFERENCE):
+        self.__prefetch += fields
+        return self
+
+    def sql(self):
+        return self.table.select(self.__columns, self.__where, self.__order_by, self.__limit, self.__offset,
+                                 self.__group_by, self.__having)
+
+    def all(self) -> List[Any]:
+        return [*self]
+
+    def first(self):
+        limit = self.__limit
+        self.__limit = 1
+        try:
+            return next(iter(self), None)
+        finally:
+            self.__limit = limit
+
+    def __iter__(self):
+        sql, params = self.sql()
+        row_factory = None if self.__columns else self.table.row_factory(self.__lazy)
+        rows = self.db.fetch(sql, *params, row_factory=row_factory)
+        if not self.__prefetch or self.__columns:
+            return rows
+        return self.__prefetched(rows)
+
+    def __prefetched(self, rows):
+        try:
+            while chunk := [*islice(rows, self.db.arraysize)]:
+                self.db.prefetch(chunk, *self.__prefetch)
+                yield from chunk
+        finally:
+            rows.close()
+
+
+class StatementEvent:
+    __slots__ = ("sql", "params", "elapsed", "rows")
+
+    def __init__(self, sql: str, params: Tuple[Any, ...], elapsed: float, rows: int):
+        self.sql = sql
+        self.params = params
+        self.elapsed = elapsed
+        self.rows = rows
+
+
+Hook = Callable[[StatementEvent], None]
+
+
+class StatementStats:
+    def __init__(self, samples: int = 1024):
+        self.samples = samples
+        self.__shapes: Dict[str, List[Any]] = {}
+        self.__lock = threading.Lock()
+
+    def __call__(self, event: StatementEvent):
+        with self.__lock:
+            shape = self.__shapes.get(event.sql)
+            if shape is None:
+                shape = self.__shapes[event.sql] = [0, 0, 0., deque(maxlen=self.samples)]
+            shape[0] += 1
+            shape[1] += max(event.rows, 0)
+            shape[2] += event.elapsed
+            shape[3].append(event.elapsed)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        report = {}
+        with self.__lock:
+            for sql, (count, rows, elapsed, samples) in self.__shapes.items():
+                samples = sorted(samples)
+                report[sql] = {
+                    "count": count,
+                    "rows": rows,
+                    "elapsed": elapsed,
+                    "p50": self.__percentile(samples, .50),
+                    "p95": self.__percentile(samples, .95),
+                    "p99": self.__percentile(samples, .99),
+                    "rows_per_sec": rows / elapsed if elapsed else 0.,
+                }
+        return report
+
+    def reset(self):
+        with self.__lock:
+            self.__shapes.clear()
+
+    @staticmethod
+    def __percentile(samples: List[float], q: float) -> float:
+        return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.
+
+
+class SQLLogger:
+    def __init__(self, level: str = "DEBUG", sample: float = 1., slower_than: float = None):
+        self.level = level
+        self.sample = sample
+        self.slower_than = slower_than
+
+    def __call__(self, event: StatementEvent):
+        if self.slower_than is not None and event.elapsed < self.slower_than:
+            return
+        if self.sample < 1. and random.random() >= self.sample:
+            return
+        logger.log(self.level, "{} {} [{} rows, {:.3f} ms]", event.sql, event.params, event.rows,
+                   event.elapsed * 1000)
+
+
+class ImportStats:
+    def __init__(self, rows: int = 0, elapsed: float = 0.):
+        self.rows = rows
+        self.elapsed = elapsed
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.elapsed if self.elapsed else 0.
+
+    def __str__(self):
+        return f"{self.rows} rows in {self.elapsed:.2f}s ({self.rows_per_sec:.0f} rows/s)"
+
+
+class Page:
+    def __init__(self, entries: List[Any], token: Optional[str]):
+        self.entries = entries
+        self.token = token
+
+    @property
+    def has_next(self) -> bool:
+        return self.token is not None
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Session:
+    def __init__(self, db: "DBManager"):
+        self.db = db
+        self.__entries: Dict[int, Entry] = {}
+
+    def add(self, *entries: Entry):
+        for entry in entries:
+            self.__entries[id(entry)] = entry
+        return self
+
+    def track(self, entries: Iterable[Entry]) -> Generator[Entry, None, None]:
+        for entry in entries:
+            self.__entries[id(entry)] = entry
+            yield entry
+
+    def dirty(self) -> List[Entry]:
+        return [entry for entry in self.__entries.values() if entry.is_dirty()]
+
+    def flush(self) -> int:
+        return self.db.flush(self.__entries.values())
+
+    def clear(self):
+        self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+        self.clear()
+
+
+class EntryCache:
+    def __init__(self, size: int, ttl: float = None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries: OrderedDict = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            item = self.__entries.get(key)
+            if item is not None and self.ttl is not None and item[1] < time.monotonic():
+                del self.__entries[key]
+                item = None
+
+            if item is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return item[0]
+
+    def put(self, key, entry: "Entry"):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.__lock:
+            self.__entries[key] = entry, expires
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys: Iterable[Any]):
+        with self.__lock:
+            for key in keys:
+                self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "size": len(self.__entries), "hit_rate": self.hits / lookups if lookups else 0.}
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+PROFILES: Dict[str, Dict[str, Any]] = {
+    "durable": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+    },
+    "balanced": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    "bulk_load": {
+        "journal_mode": "MEMORY",
+        "synchronous": "OFF",
+        "cache_size": -262144,
+        "mmap_size": 1073741824,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+
+PRAGMAS = ("page_size", "journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout",
+           "foreign_keys")
+
+
+def _pragmas(profile: Union[str, Dict[str, Any], None], overrides: Dict[str, Any] = None) -> Dict[str, Any]:
+    if isinstance(profile, str) and profile not in PROFILES:
+        raise ValueError(f"Unknown profile: {profile}")
+    pragmas = dict(PROFILES[profile] if isinstance(profile, str) else profile or {})
+    pragmas.update(overrides or {})
+
+    if unknown := set(pragmas) - set(PRAGMAS):
+        raise ValueError(f"Unknown pragmas: {', '.join(sorted(unknown))}")
+    return {key: pragmas[key] for key in PRAGMAS if key in pragmas}
+
+
+def _apply_pragmas(connection: sqlite3.Connection, pragmas: Dict[str, Any]):
+    for key, value in pragmas.items():
+        connection.execute(f"PRAGMA {key} = {value}").fetchall()
+
+
+def _picklable(value) -> bool:
+    try:
+        pickle.dumps(value)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+    return True
+
+
+def _scan_shard(path: str, pragmas: Dict[str, Any], entry_type: Type["Entry"], sql: str, low: int,
+                high: int, func: Callable, per_chunk: bool, reduce: Callable, arraysize: int) -> List[Any]:
+    connection = sqlite3.connect(f"{Path(path).absolute().as_uri()}?mode=ro", uri=True,
+                                 detect_types=sqlite3.PARSE_COLNAMES)
+    try:
+        _apply_pragmas(connection, {key: val for key, val in pragmas.items() if key not in ("page_size", "journal_mode")})
+        connection.execute("PRAGMA query_only = ON")
+
+        cursor = connection.cursor()
+        cursor.row_factory = Table("", entry_type).row_factory()
+        cursor.execute(sql, (low, high))
+
+        results = []
+        while rows := cursor.fetchmany(arraysize):
+            if per_chunk:
+                results.append(func(rows))
+            else:
+                results += map(func, rows)
+    finally:
+        connection.close()
+
+    if reduce is not None:
+        return [functools.reduce(reduce, results)] if results else []
+    return results
+
+
+NULLABLE_TYPES = {"int64": "float64", "bool": "object"}
+
+
+class ConnectionPool:
+    def __init__(self, path: str, size: int, timeout: float = 5., per_thread=False, pragmas: Dict[str, Any] = None,
+                 cached_statements: int = 128):
+        self.path = path
+        self.cached_statements = cached_statements
+        self.size = size
+        self.timeout = timeout
+        self.per_thread = per_thread
+        self.pragmas = {key: val for key, val in (pragmas or {}).items() if key not in ("page_size", "journal_mode")}
+        self.__idle = queue.LifoQueue()
+        self.__connections: List[sqlite3.Connection] = []
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def acquire(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, "connection", None)
+        if connection is not None:
+            return connection
+
+        try:
+            connection = self.__idle.get_nowait()
+        except queue.Empty:
+            connection = self.__connect()
+
+        if connection is None:
+            try:
+                connection = self.__idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise TimeoutError(f"No reader connection available after {self.timeout}s") from None
+
+        if self.per_thread:
+            self.__local.connection = connection
+        return connection
+
+    def release(self, connection: sqlite3.Connection):
+        if not self.per_thread:
+            self.__idle.put(connection)
+
+    def release_thread(self):
+        connection = getattr(self.__local, "connection", None)
+        if connection is not None:
+            self.__local.connection = None
+            self.__idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        with self.__lock:
+            for connection in self.__connections:
+                connection.close()
+            self.__connections.clear()
+
+    def __connect(self):
+        with self.__lock:
+            if len(self.__connections) >= self.size:
+                return None
+            connection = sqlite3.connect(self.path, check_same_thread=False, cached_statements=self.cached_statements,
+                                         detect_types=sqlite3.PARSE_COLNAMES)
+            _apply_pragmas(connection, self.pragmas)
+            connection.execute("PRAGMA query_only = ON")
+            self.__connections.append(connection)
+            return connection
 
 
 class DBManager:
-    def __init__(self, path: str, tables: List[Table] = None):
+    def __init__(self, path: str, tables: List[Table] = None, chunk_size: int = 10000,
+                 commit_every: int = 1, commit_interval: float = None, arraysize: int = 1000,
+                 defer_indexes=False, readers: int = 0, pool_timeout: float = 5., per_thread=False,
+                 profile: Union[str, Dict[str, Any]] = None, pragmas: Dict[str, Any] = None,
+                 cached_statements: int = 128, hooks: Iterable[Hook] = (), in_memory=False,
+                 snapshot_interval: float = None, snapshot_pages: int = -1, snapshot_sleep: float = .25):
+        self.connection: sqlite3.Connection = None
+        self.hooks: List[Hook] = [*hooks]
+        self.pool: ConnectionPool = None
         self.db_path = path
-        self.tables = {table.entry_class(): table for table in tables} or {}
-        self.__open_db()
+        self.pragmas = _pragmas(profile, pragmas)
+        self.cached_statements = cached_statements
+        self.tables = {table.entry_class(): table for table in tables or []}
+        titles = {entry: table.title for entry, table in self.tables.items()}
+        for table in self.tables.values():
+            table.bind(titles)
+        if any(isinstance(field, REFERENCE) for entry in self.tables for field in entry.__schema__.fields.values()):
+            self.pragmas.setdefault("foreign_keys", "ON")
+        self.chunk_size = chunk_size
+        self.arraysize = arraysize
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.defer_indexes = defer_indexes
+        self.in_memory = in_memory and path != ":memory:"
+        self.snapshot_pages = snapshot_pages
+        self.snapshot_sleep = snapshot_sleep
+        self.__lock = threading.RLock()
+        self.__snapshot_lock = threading.Lock()
+        self.__snapshot_changes: Tuple[int, int] = None
+        self.__snapshot_stop = threading.Event()
+        self.__snapshot_thread: threading.Thread = None
+        self.__commit_wake = threading.Event()
+        self.__commit_thread: threading.Thread = None
+        self.__owner: int = None
+        self.__depth = 0
+        self.__pending = 0
+        self.__pending_since = 0.
+        self.__stale: List[Tuple[EntryCache, List[Any]]] = []
+        self.__open_db(readers, pool_timeout, per_thread)
         self.__init_tables()
 
+        if self.in_memory and snapshot_interval:
+            self.__snapshot_thread = threading.Thread(target=self.__snapshots, args=(snapshot_interval,),
+                                                      name="sqlite-snapshot", daemon=True)
+            self.__snapshot_thread.start()
+
+        if commit_interval is not None:
+            self.__commit_thread = threading.Thread(target=self.__interval_commits, args=(commit_interval,),
+                                                    name="sqlite-commit", daemon=True)
+            self.__commit_thread.start()
+
     def execute(self, sql, *args):
-        logger.info(sql, *args)
-        self.cursor.execute(sql, args)
-        self.__save_db()
+        with self.__lock:
+            self.__statement(self.cursor.execute, sql, args)
+            self.__autocommit()
+
+    def commit(self):
+        with self.__lock:
+            if self.__depth:
+                return
+            self.__pending = 0
+            self.__save_db()
+
+    @contextmanager
+    def transaction(self):
+        with self.__lock:
+            with self.__transaction():
+                yield self
+
+    @contextmanager
+    def __transaction(self):
+        savepoint = f"sp{self.__depth}"
+
+        if self.__depth:
+            self.cursor.execute(f"SAVEPOINT {savepoint}")
+        else:
+            self.commit()
+            self.cursor.execute("BEGIN")
+            self.__owner = threading.get_ident()
+        self.__depth += 1
+
+        try:
+            yield
+        except BaseException:
+            self.__depth -= 1
+            if self.__depth:
+                self.cursor.execute(f"ROLLBACK TO {savepoint}")
+                self.cursor.execute(f"RELEASE {savepoint}")
+            else:
+                self.connection.rollback()
+                self.__stale.clear()
+            self.clear_cache()
+            raise
+
+        self.__depth -= 1
+        if self.__depth:
+            self.cursor.execute(f"RELEASE {savepoint}")
+        else:
+            self.__save_db()
+
+    def in_transaction(self):
+        return self.__depth > 0
+
+    def checkpoint(self, pages: int = None, sleep: float = None) -> bool:
+        if not self.in_memory:
+            raise ValueError("checkpoint is only available in in-memory mode")
+
+        with self.__lock:
+            if self.__depth:
+                raise ValueError("Can't checkpoint inside a transaction")
+            self.commit()
+            changes = self.__changes()
+            if changes == self.__snapshot_changes:
+                return False
+
+            snapshot = sqlite3.connect(":memory:")
+            self.connection.backup(snapshot)
+            self.__snapshot_changes = changes
+
+        with self.__snapshot_lock:
+            temp_path = f"{self.db_path}.snapshot"
+            target = sqlite3.connect(temp_path)
+            try:
+                snapshot.backup(target, pages=self.snapshot_pages if pages is None else pages,
+                                sleep=self.snapshot_sleep if sleep is None else sleep)
+            finally:
+                target.close()
+                snapshot.close()
+            os.replace(temp_path, self.db_path)
+        return True
+
+    def __changes(self) -> Tuple[int, int]:
+        return self.connection.total_changes, self.cursor.execute("PRAGMA schema_version").fetchone()[0]
+
+    def __snapshots(self, interval: float):
+        while not self.__snapshot_stop.wait(interval / 1000):
+            try:
+                self.checkpoint()
+            except Exception:
+                logger.exception("Snapshot of {} failed", self.db_path)
+
+    def __interval_commits(self, interval: float):
+        delay = None
+        while True:
+            self.__commit_wake.wait(delay)
+            self.__commit_wake.clear()
+            with self.__lock:
+                if self.connection is None:
+                    return
+                delay = None
+                if self.__pending and not self.__depth:
+                    delay = self.__pending_since + interval / 1000 - time.monotonic()
+                    if delay <= 0:
+                        self.commit()
+                        delay = None
+
+    def get_entries(self, entry_type: Type[Entry], arraysize: int = None,
+                    lazy=False) -> Generator[Entry, None, None]:
+        table = self.tables[entry_type]
+        return self.fetch(table.get_entries(), row_factory=table.row_factory(lazy), arraysize=arraysize)
+
+    def select(self, entry_type: Type[Entry], *columns: Expression) -> Select:
+        return Select(self, entry_type, *columns)
+
+    def aggregate(self, entry_type: Type[Entry], *columns: Expression,
+                  group_by: Union[Expression, Iterable[Expression]] = (), where: Condition = None,
+                  having: Condition = None, order_by: Iterable[Union[Expression, Ordering]] = None, columnar=False):
+        group_by = (group_by,) if isinstance(group_by, Expression) else tuple(group_by)
+        columns = (*(expression for expression in group_by if all(expression is not c for c in columns)), *columns)
+        query = Select(self, entry_type, *columns).group_by(*group_by)
+        query.order_by(*(group_by if order_by is None else order_by))
+        if where is not None:
+            query.where(where)
+        if having is not None:
+            query.having(having)
+
+        rows = query.all()
+        if not columnar:
+            return rows
+        return {column.name: [row[index] for row in rows] for index, column in enumerate(columns)}
+
+    def paginate(self, entry_type: Type[Entry], order_by: Union[Field, Ordering] = None, page_size: int = 100,
+                 token: str = None, where: Condition = None, lazy=False) -> Page:
+        schema = entry_type.__schema__
+        if schema.pk_name is None:
+            raise ValueError(f"Pagination needs a primary key on {entry_type.__name__}")
+
+        ordering = order_by if isinstance(order_by, Ordering) else Ordering(order_by or schema.fields[schema.pk_name])
+        field, descending = ordering.expression, ordering.descending
+        pk = schema.fields[schema.pk_name]
+        leading = {getattr(index.columns[0].expression if isinstance(index.columns[0], Ordering) else index.columns[0],
+                           "name", None) for index in schema.indexes.values() if index.columns}
+        if not isinstance(field, Field) or schema.fields.get(field.name) is not field or \
+                field is not pk and field.name not in leading:
+            raise ValueError(f"Pagination needs the primary key or an indexed column, got {field}")
+
+        keys = (pk,) if field is pk else (field, pk)
+        shape = [[key.name for key in keys], descending]
+        query = Select(self, entry_type).order_by(*(Ordering(key, descending) for key in keys)).limit(page_size + 1)
+        if where is not None:
+            query.where(where)
+
+        if token is not None:
+            try:
+                state = json.loads(base64.urlsafe_b64decode(token.encode()))
+            except (ValueError, TypeError):
+                raise ValueError("Invalid pagination token") from None
+            if not isinstance(state, list) or len(state) != 3 or \
+                    not isinstance(state[2], list) or len(state[2]) != len(keys):
+                raise ValueError("Invalid pagination token")
+            if state[:2] != shape:
+                raise ValueError("Pagination token doesn't match this query")
+            query.where(self.__seek(keys, state[2], descending))
+
+        entries = query.lazy(lazy).all()
+        if len(entries) <= page_size:
+            return Page(entries, None)
+
+        entries.pop()
+        last = entries[-1]
+        values = [key.adapt(key.__get__(last)) for key in keys]
+        values = [value.isoformat() if type(value) is Date else value for value in values]
+        return Page(entries, base64.urlsafe_b64encode(json.dumps([*shape, values]).encode()).decode())
+
+    @staticmethod
+    def __seek(keys: Tuple[Field, ...], values: List[Any], descending: bool) -> Condition:
+        operator = "<" if descending else ">"
+        if len(keys) == 1:
+            return Condition(f"{{}} {operator} {{}}", keys[0], values[0])
+
+        field, pk = keys
+        if values[0] is None:
+            after_nulls = Condition(f"({{}} IS NULL AND {{}} {operator} {{}})", field, pk, values[1])
+            return after_nulls if descending else after_nulls | ~field.is_null()
+
+        seek = Condition(f"({{}}, {{}}) {operator} ({{}}, {{}})", field, pk, *values)
+        return seek | field.is_null() if descending else seek
+
+    def prefetch(self, entries: List[Entry], *fields: REFERENCE) -> List[Entry]:
+        for field in fields:
+            keys = [*{key for entry in entries if (key := entry._values[field.index]) is not None}]
+            related = dict(zip(keys, self.get_many(field.target, keys)))
+
+            for entry in entries:
+                if getattr(entry, "_related", None) is None:
+                    entry._related = {}
+                entry._related[field.name] = related.get(entry._values[field.index])
+        return entries
+
+    def get(self, entry_type: Type[Entry], key) -> Optional[Entry]:
+        table = self.tables[entry_type]
+        if table.cache is not None and (entry := table.cache.get(key)) is not None:
+            return entry
+
+        entry = next(self.fetch(table.get_statement(), key, row_factory=table.row_factory()), None)
+        if entry is not None and table.cache is not None:
+            table.cache.put(key, entry)
+        return entry
+
+    def get_many(self, entry_type: Type[Entry], keys: Iterable[Any], chunk_size: int = 500) -> List[Optional[Entry]]:
+        table = self.tables[entry_type]
+        keys = [*keys]
+        found: Dict[Any, Entry] = {}
+        missing = []
+
+        for key in dict.fromkeys(keys):
+            if table.cache is not None and (entry := table.cache.get(key)) is not None:
+                found[key] = entry
+            else:
+                missing.append(key)
+
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            for entry in self.fetch(table.get_statement(len(chunk)), *chunk, row_factory=table.row_factory()):
+                found[entry.get_key()] = entry
+                if table.cache is not None:
+                    table.cache.put(entry.get_key(), entry)
+
+        return [found.get(key) for key in keys]
+
+    def parallel_map(self, entry_type: Type[Entry], func: Callable, workers: int = None, shards: int = None,
+                     per_chunk=False, ordered=True, reduce: Callable[[Any, Any], Any] = None, arraysize: int = None):
+        if self.db_path == ":memory:" or self.in_memory:
+            raise ValueError("Worker processes can't share an in-memory database")
+
+        table = self.tables[entry_type]
+        for name, value in (("func", func), ("reduce", reduce)):
+            if not _picklable(value):
+                raise TypeError(f"parallel_map needs a picklable {name}, such as a module-level function")
+        if not _picklable(entry_type):
+            raise TypeError(f"parallel_map needs a picklable entry class; define {entry_type.__name__} at module level")
+
+        workers = workers or os.cpu_count() or 1
+        shards = shards or workers * 4
+        arraysize = arraysize or self.arraysize
+
+        self.commit()
+        low, high = next(self.fetch(f"SELECT MIN(rowid), MAX(rowid) FROM {table.title}"))
+        step = -(-(high - low + 1) // shards) if low is not None else 1
+        ranges = [(start, start + step - 1) for start in range(low, high + 1, step)] if low is not None else []
+        sql = f"{table.get_entries()} WHERE rowid BETWEEN ? AND ?"
+        args = self.db_path, self.pragmas, entry_type, sql
+
+        results = self.__parallel(args, ranges, func, per_chunk, reduce, arraysize, workers, ordered)
+        if reduce is None:
+            return results
+        partials = [*results]
+        return functools.reduce(reduce, partials) if partials else None
+
+    @staticmethod
+    def __parallel(args, ranges, func, per_chunk, reduce, arraysize, workers, ordered):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_scan_shard, *args, low, high, func, per_chunk, reduce, arraysize)
+                       for low, high in ranges]
+            try:
+                for future in futures if ordered else as_completed(futures):
+                    yield from future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def cache_stats(self) -> Dict[str, float]:
+        stats = {"hits": 0, "misses": 0, "evictions": 0, "size": 0}
+        for table in self.tables.values():
+            for key, val in table.cache_stats().items():
+                if key in stats:
+                    stats[key] += val
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.
+        return stats
+
+    def clear_cache(self, *entry_types: Type[Entry]):
+        for entry_type in entry_types or self.tables:
+            if self.tables[entry_type].cache is not None:
+                self.tables[entry_type].cache.clear()
+
+    def fetch(self, sql, *args, row_factory=None, arraysize: int = None) -> Generator[Any, None, None]:
+        arraysize = arraysize or self.arraysize
+        if self.__depth:
+            writer = self.__owner == threading.get_ident()
+        else:
+            writer = self.connection.in_transaction
+        connection = None if self.pool is None or writer else self.pool.acquire()
+
+        try:
+            if not self.hooks:
+                cursor = self.__query(connection or self.connection, sql, *args, row_factory=row_factory)
+                try:
+                    while rows := cursor.fetchmany(arraysize):
+                        yield from rows
+                finally:
+                    cursor.close()
+                return
+
+            started = time.perf_counter()
+            cursor = self.__query(connection or self.connection, sql, *args, row_factory=row_factory)
+            elapsed, count = time.perf_counter() - started, 0
+            try:
+                while True:
+                    started = time.perf_counter()
+                    rows = cursor.fetchmany(arraysize)
+                    elapsed += time.perf_counter() - started
+                    if not rows:
+                        break
+                    count += len(rows)
+                    yield from rows
+            finally:
+                cursor.close()
+                self.__emit(sql, args, elapsed, count)
+        finally:
+            if connection is not None:
+                self.pool.release(connection)
+
+    def fetch_columns(self, entry_type: Type[Entry], columns: Iterable[Field] = (), where: Condition = None,
+                      structured=False, chunk_size: int = None):
+        if numpy is None:
+            raise ImportError("fetch_columns requires numpy")
 
-    def get_entries(self, entry_type: Type[Entry]):
         table = self.tables[entry_type]
-        self.execute(table.get_entries())
-        for data in self.cursor.fetchall():
-            yield table.entry(*data)
+        fields = [*columns] or [*entry_type.__schema__.fields.values()]
+        chunk_size = chunk_size or self.chunk_size
+
+        params = []
+        where = f" WHERE {where.__sql__(params)}" if where is not None else ""
+        dtype = [(field.name, field.type.numpy_type()) for field in fields]
+
+        def allocate(size):
+            if structured:
+                return numpy.empty(size, dtype=dtype)
+            return {name: numpy.empty(size, dtype=_type) for name, _type in dtype}
+
+        result, position, capacity = allocate(chunk_size), 0, chunk_size
+        rows = self.fetch(f"SELECT {', '.join(field.name for field in fields)} FROM {table.title}{where}", *params,
+                          arraysize=chunk_size)
+
+        while chunk := [*islice(rows, chunk_size)]:
+            size = len(chunk)
+            if position + size > capacity:
+                grown = allocate(capacity := max(position + size, capacity * 2))
+                for name, _ in dtype:
+                    grown[name][:position] = result[name][:position]
+                result = grown
+
+            for index, (name, _type) in enumerate(dtype):
+                values = [row[index] for row in chunk]
+                if _type in NULLABLE_TYPES and None in values:
+                    dtype[index] = name, _type = name, NULLABLE_TYPES[_type]
+                    if structured:
+                        result = result.astype(dtype)
+                    else:
+                        result[name] = result[name].astype(_type)
+                if _type == "object" and fields[index].type.py_type() is bool:
+                    values = [value if value is None else bool(value) for value in values]
+                result[name][position:position + size] = values
+            position += size
+
+        if position < capacity:
+            result = result[:position].copy() if structured else \
+                {name: array[:position].copy() for name, array in result.items()}
+        return result
+
+    def import_file(self, entry_type: Type[Entry], path: str, format: str = None, chunk_size: int = None,
+                    profile: Union[str, Dict[str, Any], None] = None, defer_indexes=False,
+                    progress: Callable[[ImportStats], None] = None, encoding="utf-8", **csv_options) -> ImportStats:
+        format = format or os.path.splitext(path)[1].lstrip(".").lower()
+        if format not in ("csv", "jsonl", "ndjson"):
+            raise ValueError(f"Unknown import format: {format}")
+
+        table = self.tables[entry_type]
+        fields = entry_type.__schema__.fields
+        chunk_size = chunk_size or self.chunk_size
+        stats = ImportStats()
+        started = time.perf_counter()
+
+        with open(path, newline="" if format == "csv" else None, encoding=encoding) as file, \
+                self.use_profile(profile) if profile else nullcontext(), \
+                self.without_indexes(entry_type) if defer_indexes else nullcontext():
+            if format == "csv":
+                reader = csv.reader(file, **csv_options)
+                header = next(reader, [])
+                columns = [(index, fields[name]) for index, name in enumerate(header) if name in fields]
+                rows = self.__csv_rows(reader, columns, len(header))
+            else:
+                columns = [*fields.items()]
+                rows = ([field.coerce(record.get(name)) for name, field in columns]
+                        for record in map(json.loads, filter(str.strip, file)) if record)
+
+            sql = table.statement("insert", columns=tuple(field.name for _, field in columns))
 
-    def insert_entries(self, entries: List[Entry]):
+            while chunk := [*islice(rows, chunk_size)]:
+                with self.transaction():
+                    self.__statement(self.cursor.executemany, sql, chunk, many=True)
+                stats.rows += len(chunk)
+                stats.elapsed = time.perf_counter() - started
+                if progress is not None:
+                    progress(stats)
+
+        self.clear_cache(entry_type)
+        stats.elapsed = time.perf_counter() - started
+        return stats
+
+    @staticmethod
+    def __csv_rows(reader, columns: List[Tuple[int, Field]], width: int) -> Generator[List[Any], None, None]:
+        for row in reader:
+            if len(row) < width:
+                raise ValueError(f"Line {reader.line_num}: expected {width} cells, got {len(row)}")
+            yield [field.coerce(row[index]) for index, field in columns]
+
+    def insert_entries(self, entries: Iterable[Entry], primary_key=False, chunk_size: int = None,
+                       return_ids=False) -> Union[int, List[int]]:
+        with self.__lock:
+            return self.__insert_entries(entries, primary_key, chunk_size, return_ids)
+
+    def __insert_entries(self, entries: Iterable[Entry], primary_key, chunk_size, return_ids):
+        if return_ids:
+            ids = []
+            for entry in entries:
+                self.__statement(self.cursor.execute, self.tables[type(entry)].insert_statement(primary_key=primary_key),
+                                 entry.get_params(primary_key=primary_key))
+                ids.append(self.cursor.lastrowid)
+                self.__invalidate(type(entry), (self.cursor.lastrowid,))
+                entry._dirty = 0 if primary_key else _UNSAVED
+            self.__autocommit()
+            return ids
+
+        groups = self.__group(entries)
+        chunk_size = chunk_size or self.chunk_size
+        inserted = 0
+
+        for entry_type, group in groups.items():
+            sql = self.tables[entry_type].insert_statement(primary_key=primary_key)
+            rows = (entry.get_params(primary_key=primary_key) for entry in group)
+            if primary_key:
+                self.__invalidate(entry_type, [entry.get_key() for entry in group])
+
+            while chunk := [*islice(rows, chunk_size)]:
+                self.__statement(self.cursor.executemany, sql, chunk, many=True)
+                inserted += self.cursor.rowcount
+                self.__autocommit()
+
+            dirty = 0 if primary_key else _UNSAVED
+            for entry in group:
+                entry._dirty = dirty
+
+        return inserted
+
+    def upsert_entries(self, entries: Iterable[Entry], conflict: str = "update", columns: Tuple[str, ...] = None,
+                       chunk_size: int = None) -> int:
+        if conflict not in ("update", "ignore"):
+            raise ValueError(f"Unknown conflict action: {conflict}")
+
+        columns = () if conflict == "ignore" else columns
+        groups = self.__group(entries)
+        for entry_type, group in groups.items():
+            if not all(map(Entry.is_saved, group)):
+                raise ValueError(f"Can't upsert {entry_type.__name__} without a primary key")
+        return self.__batch(groups, lambda table: table.upsert_statement(columns),
+                            lambda entry: entry.get_params(primary_key=True), chunk_size, saved=Entry.mark_clean)
+
+    def update_entries(self, entries: Iterable[Entry], columns: Iterable[str] = None, chunk_size: int = None) -> int:
+        columns = None if columns is None else tuple(columns)
+        return self.__batch(self.__group(entries), lambda table: table.update_statement(columns),
+                            lambda entry: [*entry.get_params(columns=columns), entry.get_key()], chunk_size,
+                            saved=lambda entry: entry.mark_clean(columns))
+
+    def delete_entries(self, entries: Iterable[Union[Entry, Any]], entry_type: Type[Entry] = None,
+                       chunk_size: int = None) -> int:
+        if entry_type is not None:
+            return self.__batch({entry_type: [*entries]}, Table.delete_statement, lambda key: (key,), chunk_size,
+                                key=lambda key: key)
+        return self.__batch(self.__group(entries), Table.delete_statement, lambda entry: (entry.get_key(),),
+                            chunk_size)
+
+    def flush(self, entries: Iterable[Entry], chunk_size: int = None) -> int:
+        groups: Dict[Tuple[Type[Entry], int], List[Entry]] = {}
         for entry in entries:
-            self.execute(self.tables[type(entry)].insert_entry(entry))
+            if not entry.is_dirty():
+                continue
+            if not entry.is_saved():
+                raise ValueError(f"Can't flush {type(entry).__name__} that was never loaded or inserted")
+            groups.setdefault((type(entry), entry._dirty), []).append(entry)
 
-    def __init_tables(self):
+        if not groups:
+            return 0
+
+        affected = 0
+        with self.transaction():
+            for (entry_type, dirty), group in groups.items():
+                schema = entry_type.__schema__
+                if schema.pk_index is not None and dirty >> schema.pk_index & 1:
+                    raise ValueError(f"Can't flush a changed primary key of {entry_type.__name__}")
+                columns = tuple(name for index, name in enumerate(schema.names) if dirty >> index & 1)
+                affected += self.update_entries(group, columns, chunk_size)
+
+        return affected
+
+    def session(self) -> Session:
+        return Session(self)
+
+    @staticmethod
+    def __group(entries: Iterable[Entry]) -> Dict[Type[Entry], List[Entry]]:
+        groups: Dict[Type[Entry], List[Entry]] = {}
+        for entry in entries:
+            groups.setdefault(type(entry), []).append(entry)
+        return groups
+
+    def __batch(self, groups: Dict[Type[Entry], List[Any]], statement: Callable[[Table], str],
+                params: Callable[[Any], List[Any]], chunk_size: int = None,
+                key: Callable[[Any], Any] = Entry.get_key, saved: Callable[[Entry], Any] = None) -> int:
+        chunk_size = chunk_size or self.chunk_size
+        affected = 0
+
+        with self.transaction():
+            for entry_type, group in groups.items():
+                sql = statement(self.tables[entry_type])
+                self.__invalidate(entry_type, [*map(key, group)])
+                rows = map(params, group)
+
+                while chunk := [*islice(rows, chunk_size)]:
+                    self.__statement(self.cursor.executemany, sql, chunk, many=True)
+                    affected += self.cursor.rowcount
+
+        if saved is not None:
+            for group in groups.values():
+                for entry in group:
+                    saved(entry)
+        return affected
+
+    def __invalidate(self, entry_type: Type[Entry], keys: List[Any]):
+        cache = self.tables[entry_type].cache
+        if cache is not None and keys:
+            cache.invalidate(keys)
+            self.__stale.append((cache, keys))
+
+    def __query(self, connection: sqlite3.Connection, sql, *args, row_factory=None) -> sqlite3.Cursor:
+        cursor = connection.cursor()
+        cursor.row_factory = row_factory
+        cursor.execute(sql, args)
+        return cursor
+
+    def __statement(self, method, sql, params, many=False):
+        if not self.hooks:
+            return method(sql, params)
+
+        started = time.perf_counter()
+        method(sql, params)
+        self.__emit(sql, () if many else tuple(params), time.perf_counter() - started, self.cursor.rowcount)
+
+    def __emit(self, sql, params, elapsed, rows):
+        event = StatementEvent(sql, params, elapsed, rows)
+        for hook in self.hooks:
+            hook(event)
+
+    @contextmanager
+    def use_profile(self, profile: Union[str, Dict[str, Any]], **overrides):
+        pragmas = _pragmas(profile, overrides)
+        pragmas.pop("page_size", None)
+        if self.pool is not None:
+            pragmas.pop("journal_mode", None)
+
+        with self.__lock:
+            self.commit()
+            previous = {key: self.cursor.execute(f"PRAGMA {key}").fetchone()[0] for key in pragmas}
+            _apply_pragmas(self.connection, pragmas)
+            try:
+                yield self
+            finally:
+                self.commit()
+                _apply_pragmas(self.connection, previous)
+
+    def statement_stats(self) -> Dict[str, int]:
+        stats = {"hits": 0, "misses": 0, "size": 0}
         for table in self.tables.values():
-            self.execute(table.init())
+            for key, val in table.statement_stats().items():
+                stats[key] += val
+        return stats
+
+    def create_indexes(self, *entry_types: Type[Entry]):
+        with self.transaction():
+            for entry_type in entry_types or self.tables:
+                for sql in self.tables[entry_type].create_indexes():
+                    self.execute(sql)
+
+    def drop_indexes(self, *entry_types: Type[Entry]):
+        with self.transaction():
+            for entry_type in entry_types or self.tables:
+                for sql in self.tables[entry_type].drop_indexes():
+                    self.execute(sql)
+
+    @contextmanager
+    def without_indexes(self, *entry_types: Type[Entry]):
+        self.drop_indexes(*entry_types)
+        try:
+            yield self
+        finally:
+            self.create_indexes(*entry_types)
+
+    def schema_fingerprint(self) -> int:
+        digest = hashlib.sha256()
+        for table in sorted(self.tables.values(), key=lambda table: table.title):
+            digest.update(table.init().encode())
+            if not self.defer_indexes:
+                digest.update("".join(table.create_indexes()).encode())
+        return int.from_bytes(digest.digest()[:4], "big", signed=True) or 1
+
+    def __init_tables(self):
+        if not self.tables:
+            return
+
+        fingerprint = self.schema_fingerprint()
+        if self.cursor.execute("PRAGMA user_version").fetchone()[0] == fingerprint:
+            return
+
+        logger.info("Migrating schema of {}", self.db_path)
+        with self.transaction():
+            for table in self.tables.values():
+                columns = [row[1] for row in self.cursor.execute(f"PRAGMA table_info({table.title})").fetchall()]
+                for sql in table.migrate(columns):
+                    self.execute(sql)
+            if not self.defer_indexes:
+                self.create_indexes()
+            self.execute(f"PRAGMA user_version = {fingerprint}")
+
+    def close(self):
+        if self.connection is None:
+            return
+
+        logger.info("Closing database")
+        if self.__snapshot_thread is not None:
+            self.__snapshot_stop.set()
+            self.__snapshot_thread.join()
+            self.__snapshot_thread = None
+
+        with self.__lock:
+            self.__save_db()
+            if self.in_memory:
+                self.checkpoint()
+            self.__close_db()
+
+        if self.__commit_thread is not None:
+            self.__commit_wake.set()
+            if self.__commit_thread is not threading.current_thread():
+                self.__commit_thread.join()
+            self.__commit_thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
-    def __open_db(self):
-        self.connection = sqlite3.connect(self.db_path)
+    def __open_db(self, readers: int, pool_timeout: float, per_thread: bool):
+        if readers and (self.db_path == ":memory:" or self.in_memory):
+            raise ValueError("Reader connections can't share an in-memory database")
+
+        if readers:
+            self.pragmas["journal_mode"] = "WAL"
+
+        self.connection = sqlite3.connect(":memory:" if self.in_memory else self.db_path,
+                                          check_same_thread=not (readers or self.in_memory or
+                                                                 self.commit_interval is not None),
+                                          cached_statements=self.cached_statements,
+                                          detect_types=sqlite3.PARSE_COLNAMES)
         self.cursor = self.connection.cursor()
 
+        if self.in_memory and os.path.exists(self.db_path):
+            source = sqlite3.connect(self.db_path)
+            try:
+                source.backup(self.connection)
+            finally:
+                source.close()
+            self.__snapshot_changes = self.__changes()
+        _apply_pragmas(self.connection, self.pragmas)
+
+        if readers:
+            self.pool = ConnectionPool(self.db_path, readers, pool_timeout, per_thread, self.pragmas,
+                                       self.cached_statements)
+
     def __del__(self):
-        logger.info("Closing database")
-        self.__save_db()
-        self.__close_db()
+        self.close()
+
+    def __autocommit(self):
+        if self.__depth:
+            return
+
+        self.__pending += 1
+        if self.__pending == 1:
+            self.__pending_since = time.monotonic()
+            self.__commit_wake.set()
+
+        if self.commit_every and self.__pending >= self.commit_every:
+            self.commit()
+        elif self.commit_interval is not None and \
+                (time.monotonic() - self.__pending_since) * 1000 >= self.commit_interval:
+            self.commit()
 
     def __save_db(self):
         self.connection.commit()
+        for cache, keys in self.__stale:
+            cache.invalidate(keys)
+        self.__stale.clear()
 
     def __close_db(self):
+        if self.pool is not None:
+            self.pool.close()
         self.connection.close()
+        self.connection = None
@@ -1,7 +1,26 @@
+import base64
+import datetime
+import operator
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 import sqlite_lib as sql_lib
 
 
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = self.temp_path("test.db")
+
+    def temp_path(self, name):
+        return os.path.join(self.directory, name)
+
+
 class FieldTest(unittest.TestCase):
     def test_int(self):
         instance = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
@@ -16,6 +35,37 @@ class FieldTest(unittest.TestCase):
         self.assertEqual("TEXT", str(instance))
 
 
+class DateTest(unittest.TestCase):
+    def test_leap_years(self):
+        self.assertEqual(29, sql_lib.Date(2000, 2, 29).day)
+        self.assertEqual(29, sql_lib.Date(2024, 2, 29).day)
+        for year in (1900, 2023, 2100):
+            with self.assertRaises(ValueError):
+                sql_lib.Date(year, 2, 29)
+        with self.assertRaises(ValueError):
+            sql_lib.Date(2020, 4, 31)
+
+    def test_fromstr(self):
+        self.assertEqual(sql_lib.Date(2021, 3, 4, 5, 6, 7), sql_lib.Date.fromstr("2021-03-04 05:06:07"))
+        self.assertEqual(sql_lib.Date(2021, 3, 4, 5, 6, 7), sql_lib.Date.fromstr("2021-03-04T05:06:07.123"))
+        self.assertEqual(sql_lib.Date(2021, 3, 4), sql_lib.Date.fromstr("2021-03-04"))
+        self.assertEqual(sql_lib.Date(2021, 3, 4, 5), sql_lib.Date.fromstr("04/03/2021 05h", "%d/%m/%Y %Hh"))
+        with self.assertRaises(ValueError):
+            sql_lib.Date.fromstr("2021-02-30")
+
+    def test_batch_and_epoch(self):
+        dates = sql_lib.Date.fromstrs(["2021-03-04 05:06:07", b"1999-12-31", None])
+        self.assertEqual([sql_lib.Date(2021, 3, 4, 5, 6, 7), sql_lib.Date(1999, 12, 31), None], dates)
+        with self.assertRaises(ValueError):
+            sql_lib.Date.fromstrs(["2021-02-30"])
+        with self.assertRaises(ValueError):
+            sql_lib.Date.frombytes(b"2021-01-01 24:00:00")
+
+        self.assertEqual(0, sql_lib.Date().epoch())
+        self.assertEqual(951782400, sql_lib.Date(2000, 2, 29).epoch())
+        self.assertEqual([sql_lib.Date(2000, 2, 29), None], sql_lib.Date.fromepochs([951782400, None]))
+
+
 class EntryTest(unittest.TestCase):
     def test_set_get_attr(self):
         class A(sql_lib.Entry):
@@ -61,6 +111,29 @@ class EntryTest(unittest.TestCase):
         self.assertEqual([1, 3, 1], instance.get_vals(primary_key=True))
         self.assertEqual([3, 1], instance.get_vals(primary_key=False))
 
+    def test_schema(self):
+        class A(sql_lib.Entry):
+            id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+            a = sql_lib.TEXT()
+            b = sql_lib.REAL()
+
+        class B(A):
+            c = sql_lib.DATE()
+
+        schema = B.__schema__
+        self.assertEqual(("id", "a", "b", "c"), schema.names)
+        self.assertEqual((True, False, False, False), schema.primary_key)
+        self.assertEqual((int, str, float, sql_lib.Date), schema.types)
+        self.assertEqual("a, b, c", B.get_fields_on_insert())
+        self.assertIs(A.a, schema.fields["a"])
+
+        instance = B(a="x", c=sql_lib.Date(2000, 2, 29))
+        self.assertFalse(hasattr(instance, "__dict__"))
+        self.assertEqual([0, "x", 0.], [*instance][:3])
+        self.assertEqual("2000-02-29 00:00:00", instance.c.isoformat())
+        with self.assertRaises(AttributeError):
+            instance.unknown = 1
+
 
 class TableTest(unittest.TestCase):
     def test_init(self):
@@ -88,6 +161,1160 @@ class TableTest(unittest.TestCase):
             "INSERT INTO test (id, a, b) VALUES (1, 2, 3)",
             table.insert_entry(entry, primary_key=True))
 
+    def test_insert_escapes_literals(self):
+        class A(sql_lib.Entry):
+            id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+            a = sql_lib.TEXT()
+            b = sql_lib.DATE()
+
+        table = sql_lib.Table("test", A)
+        entry = A(a="it's'); DROP TABLE test; --")
+
+        self.assertEqual(
+            "INSERT INTO test (a, b) VALUES ('it''s''); DROP TABLE test; --', '1970-01-01 00:00:00')",
+            table.insert_entry(entry))
+
+    def test_insert_statement(self):
+        class A(sql_lib.Entry):
+            id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+            a = sql_lib.INTEGER()
+            b = sql_lib.TEXT()
+
+        table = sql_lib.Table("test", A)
+
+        self.assertEqual("INSERT INTO test (a, b) VALUES (?, ?)", table.insert_statement())
+        self.assertEqual("INSERT INTO test (id, a, b) VALUES (?, ?, ?)", table.insert_statement(primary_key=True))
+
+    def test_insert_default_values(self):
+        class A(sql_lib.Entry):
+            id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+
+        table = sql_lib.Table("test", A)
+        self.assertEqual("INSERT INTO test DEFAULT VALUES", table.insert_statement())
+        self.assertEqual("INSERT INTO test DEFAULT VALUES", table.insert_entry(A()))
+
+        db = sql_lib.DBManager(":memory:", tables=[table])
+        self.addCleanup(db.close)
+        self.assertEqual(2, db.insert_entries([A(), A()]))
+        self.assertEqual([3], db.insert_entries([A()], return_ids=True))
+        self.assertEqual([(1,), (2,), (3,)], [tuple(entry) for entry in db.get_entries(A)])
+
+    def test_statement_cache(self):
+        class A(sql_lib.Entry):
+            id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+            a = sql_lib.INTEGER()
+            b = sql_lib.TEXT()
+
+        class B(sql_lib.Entry):
+            a = sql_lib.INTEGER()
+
+        table = sql_lib.Table("test", A)
+
+        self.assertEqual("UPDATE test SET a = ?, b = ? WHERE id = ?", table.update_statement())
+        self.assertEqual("UPDATE test SET b = ? WHERE id = ?", table.update_statement(("b",)))
+        self.assertEqual("DELETE FROM test WHERE id = ?", table.delete_statement())
+        self.assertIs(table.insert_statement(), table.insert_statement())
+        self.assertEqual({"hits": 1, "misses": 4, "size": 4}, table.statement_stats())
+
+        with self.assertRaises(ValueError):
+            sql_lib.Table("test", B).delete_statement()
+
+
+class DBManagerTest(unittest.TestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT()
+        created_at = sql_lib.DATE()
+
+    def setUp(self):
+        self.db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("users", self.User)])
+
+    def rows(self):
+        self.db.execute("SELECT id, username, created_at FROM users ORDER BY id")
+        return self.db.cursor.fetchall()
+
+    def test_insert_entries(self):
+        users = [self.User(username=f"user'{i}", created_at=sql_lib.Date(2020, 1, i + 1)) for i in range(5)]
+
+        self.assertEqual(5, self.db.insert_entries(users, chunk_size=2))
+        self.assertEqual((1, "user'0", "2020-01-01 00:00:00"), self.rows()[0])
+        self.assertEqual(5, len(self.rows()))
+
+    def test_insert_entries_return_ids(self):
+        users = [self.User(username=name) for name in ("a", "b", "c")]
+
+        self.assertEqual([1, 2, 3], self.db.insert_entries(users, return_ids=True))
+        self.assertEqual(["a", "b", "c"], [row[1] for row in self.rows()])
+
+    def test_statement_stats(self):
+        before = self.db.statement_stats()
+        for _ in range(3):
+            self.db.insert_entries([self.User(username="a")])
+            [*self.db.get_entries(self.User)]
+
+        after = self.db.statement_stats()
+        self.assertEqual(4, after["hits"] - before["hits"])
+        self.assertEqual(2, after["misses"] - before["misses"])
+
+    def test_get_entries_streams(self):
+        self.db.insert_entries([self.User(username=str(i)) for i in range(10)])
+
+        entries = self.db.get_entries(self.User, arraysize=3)
+        first = next(entries)
+        self.db.execute("SELECT COUNT(*) FROM users")
+        rest = [*entries]
+
+        self.assertEqual((1, "0"), (first.id, first.username))
+        self.assertEqual([*range(2, 11)], [entry.id for entry in rest])
+
+    def test_get_entries_close(self):
+        self.db.insert_entries([self.User(username=str(i)) for i in range(10)])
+
+        entries = self.db.get_entries(self.User, arraysize=2)
+        next(entries)
+        entries.close()
+
+        self.assertEqual(10, len(self.rows()))
+
+    def test_get_entries_lazy(self):
+        self.db.insert_entries([self.User(username="a"), self.User(username="b")])
+
+        first, second = self.db.get_entries(self.User, lazy=True)
+        self.assertIs(tuple, type(first._values))
+        self.assertEqual((1, "a"), (first.id, first.username))
+
+        second.username = "c"
+        self.assertIs(list, type(second._values))
+        self.assertEqual([2, "c", sql_lib.Date()], second.get_vals(primary_key=True))
+        self.assertEqual((1, "a"), (first.id, first.username))
+
+
+class DateStorageTest(unittest.TestCase):
+    class Event(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        text = sql_lib.DATE()
+        epoch = sql_lib.DATE(storage="epoch")
+
+    def setUp(self):
+        self.db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("events", self.Event)])
+        self.db.insert_entries([self.Event(text=sql_lib.Date(2020, 1, day), epoch=sql_lib.Date(2020, 1, day, 12))
+                                for day in range(1, 6)])
+
+    def test_storage(self):
+        self.assertEqual("epoch INTEGER", f"epoch {self.Event.epoch}")
+        self.db.execute("SELECT text, epoch FROM events WHERE id = 1")
+        self.assertEqual(("2020-01-01 00:00:00", 1577880000), self.db.cursor.fetchone())
+
+    def test_roundtrip(self):
+        entry = next(self.db.get_entries(self.Event))
+        self.assertEqual(sql_lib.Date(2020, 1, 1), entry.text)
+        self.assertEqual(sql_lib.Date(2020, 1, 1, 12), entry.epoch)
+
+    def test_range_query(self):
+        Event = self.Event
+        query = self.db.select(Event, Event.id, Event.epoch).where(
+            Event.epoch.between(sql_lib.Date(2020, 1, 2), sql_lib.Date(2020, 1, 3, 23)),
+            Event.text < sql_lib.Date(2020, 1, 3))
+
+        self.assertEqual([(2, sql_lib.Date(2020, 1, 2, 12))], query.all())
+
+    def test_stdlib_converters_untouched(self):
+        connection = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES)
+        self.addCleanup(connection.close)
+        connection.execute("CREATE TABLE t (d date)")
+        connection.execute("INSERT INTO t VALUES ('2020-01-02')")
+        self.assertEqual(datetime.date(2020, 1, 2), connection.execute("SELECT d FROM t").fetchone()[0])
+
+
+@unittest.skipUnless(sql_lib.numpy, "numpy is not installed")
+class FetchColumnsTest(unittest.TestCase):
+    class Event(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        name = sql_lib.TEXT()
+        value = sql_lib.REAL()
+        at = sql_lib.DATE()
+        epoch = sql_lib.DATE(storage="epoch")
+
+    def setUp(self):
+        self.db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("events", self.Event)])
+        self.db.insert_entries([self.Event(name=str(i), value=i / 2, at=sql_lib.Date(2020, 1, 1 + i),
+                                           epoch=sql_lib.Date(2021, 1, 1 + i)) for i in range(10)])
+
+    def test_columns(self):
+        Event = self.Event
+        statements = []
+        self.db.hooks.append(lambda event: statements.append(event.sql))
+        columns = self.db.fetch_columns(Event, where=Event.id > 5, chunk_size=3)
+
+        self.assertEqual(["SELECT id, name, value, at, epoch FROM events WHERE id > ?"], statements)
+        self.assertEqual([6, 7, 8, 9, 10], columns["id"].tolist())
+        self.assertEqual("int64", columns["id"].dtype.name)
+        self.assertEqual("float64", columns["value"].dtype.name)
+        self.assertEqual(["5", "6", "7", "8", "9"], columns["name"].tolist())
+        self.assertEqual(sql_lib.numpy.datetime64("2020-01-06T00:00:00"), columns["at"][0])
+        self.assertEqual(sql_lib.numpy.datetime64("2021-01-10T00:00:00"), columns["epoch"][-1])
+
+    def test_structured(self):
+        Event = self.Event
+        array = self.db.fetch_columns(Event, columns=[Event.id, Event.value], structured=True, chunk_size=4)
+
+        self.assertEqual(("id", "value"), array.dtype.names)
+        self.assertEqual(10, len(array))
+        self.assertEqual(4.5, array["value"][-1])
+
+    def test_nulls(self):
+        class Flag(sql_lib.Entry):
+            id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+            count = sql_lib.INTEGER()
+            active = sql_lib.Field(sql_lib.SQLTypes.BOOLEAN)
+
+        db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("flags", Flag)])
+        self.addCleanup(db.close)
+        db.execute("INSERT INTO flags (count, active) VALUES (1, 1), (2, 0), (NULL, NULL)")
+
+        for structured, chunk_size in ((False, 2), (True, 2), (False, 3)):
+            columns = db.fetch_columns(Flag, structured=structured, chunk_size=chunk_size)
+            self.assertEqual("int64", columns["id"].dtype.name)
+            self.assertEqual("float64", columns["count"].dtype.name)
+            self.assertEqual([1., 2.], columns["count"][:2].tolist())
+            self.assertTrue(sql_lib.numpy.isnan(columns["count"][2]))
+            self.assertEqual([True, False, None], columns["active"].tolist())
+
+
+class IndexTest(unittest.TestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT() + sql_lib.SQLParams.NOT_NULL + sql_lib.SQLParams.UNIQUE
+        score = sql_lib.REAL() + sql_lib.SQLParams.INDEX
+        created_at = sql_lib.DATE()
+
+        by_day = sql_lib.Index(created_at, score.desc(), include=[username])
+        active = sql_lib.Index(username, where=(score > 0.) & (username != "it's"))
+
+    def indexes(self, db):
+        db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'users' ORDER BY name")
+        return [row[0] for row in db.cursor.fetchall()]
+
+    def test_create(self):
+        table = sql_lib.Table("users", self.User)
+
+        self.assertEqual("username TEXT NOT NULL", f"username {self.User.username}")
+        self.assertEqual([
+            "CREATE INDEX IF NOT EXISTS users_by_day ON users (created_at, score DESC, username)",
+            "CREATE INDEX IF NOT EXISTS users_active ON users (username) WHERE (score > 0.0 AND username != 'it''s')",
+            "CREATE UNIQUE INDEX IF NOT EXISTS users_username_idx ON users (username)",
+            "CREATE INDEX IF NOT EXISTS users_score_idx ON users (score)",
+        ], table.create_indexes())
+
+    def test_deferred(self):
+        db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("users", self.User)], defer_indexes=True)
+        self.assertEqual([], self.indexes(db))
+
+        db.create_indexes()
+        db.create_indexes()
+        names = ["users_active", "users_by_day", "users_score_idx", "users_username_idx"]
+        self.assertEqual(names, self.indexes(db))
+
+        with db.without_indexes(self.User):
+            self.assertEqual([], self.indexes(db))
+            db.insert_entries([self.User(username="a"), self.User(username="b")])
+        self.assertEqual(names, self.indexes(db))
+
+
+class SelectTest(unittest.TestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT()
+        score = sql_lib.REAL()
+
+    def setUp(self):
+        self.db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("users", self.User)])
+        self.db.insert_entries([self.User(username=name, score=float(score))
+                                for name, score in (("ann", 3), ("bob", 1), ("bea", 2), ("carl", 5))])
+
+    def test_compile(self):
+        User = self.User
+        query = self.db.select(User).where((User.username == "ann") | User.score.between(1., 2.),
+                                           User.id.in_([1, 2])).order_by(User.score.desc()).limit(10)
+
+        self.assertEqual(
+            ("SELECT id, username, score FROM users WHERE ((username = ? OR score BETWEEN ? AND ?) AND id IN (?, ?))"
+             " ORDER BY score DESC LIMIT ? OFFSET ?", ["ann", 1., 2., 1, 2, 10, 0]),
+            query.sql())
+
+    def test_where_order_limit(self):
+        User = self.User
+        entries = self.db.select(User).where(User.username.like("b%"), User.score > 0.).order_by(User.username)
+
+        self.assertEqual(["bea", "bob"], [entry.username for entry in entries])
+        self.assertEqual("carl", self.db.select(User).order_by(User.score.desc()).first().username)
+        self.assertEqual(["bea"], [entry.username for entry in
+                                   self.db.select(User).order_by(User.score).limit(1, offset=1)])
+
+    def test_projection(self):
+        User = self.User
+        rows = self.db.select(User, User.username).where(~User.id.in_([1, 2]), User.score != None).order_by(User.id)
+
+        self.assertEqual([("bea",), ("carl",)], rows.all())
+        self.assertEqual([], self.db.select(User).where(User.id.in_([])).all())
+
+    def test_condition_is_not_bool(self):
+        with self.assertRaises(TypeError):
+            bool(self.User.id == 1)
+
+
+class InstrumentationTest(unittest.TestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT()
+
+    def setUp(self):
+        self.events = []
+        self.stats = sql_lib.StatementStats()
+        self.db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("users", self.User)])
+        self.db.hooks += [self.events.append, self.stats]
+
+    def test_events(self):
+        self.db.insert_entries([self.User(username=str(i)) for i in range(5)], chunk_size=3)
+        [*self.db.select(self.User).where(self.User.id > 1)]
+        self.db.execute("DELETE FROM users WHERE id = ?", 1)
+
+        self.assertEqual([("INSERT INTO users (username) VALUES (?)", (), 3),
+                          ("INSERT INTO users (username) VALUES (?)", (), 2),
+                          ("SELECT id, username FROM users WHERE id > ?", (1,), 4),
+                          ("DELETE FROM users WHERE id = ?", (1,), 1)],
+                         [(event.sql, event.params, event.rows) for event in self.events])
+        self.assertTrue(all(event.elapsed >= 0 for event in self.events))
+
+    def test_stats(self):
+        for _ in range(10):
+            self.db.insert_entries([self.User(username="a")])
+
+        report = self.stats.report()["INSERT INTO users (username) VALUES (?)"]
+        self.assertEqual((10, 10), (report["count"], report["rows"]))
+        self.assertLessEqual(report["p50"], report["p95"])
+        self.assertLessEqual(report["p95"], report["p99"])
+        self.assertGreater(report["rows_per_sec"], 0)
+
+    def test_sql_logger(self):
+        messages = []
+        sink = sql_lib.logger.add(messages.append, level="DEBUG", format="{message}")
+        self.addCleanup(sql_lib.logger.remove, sink)
+
+        self.db.hooks = [sql_lib.SQLLogger(sample=0.)]
+        self.db.execute("SELECT '{}'")
+        self.db.hooks = [sql_lib.SQLLogger()]
+        self.db.execute("SELECT '{}'")
+
+        self.assertEqual(1, len(messages))
+        self.assertTrue(messages[0].startswith("SELECT '{}' ()"))
+
+
+class ImportTest(TempDirTestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT() + sql_lib.SQLParams.INDEX
+        score = sql_lib.REAL()
+        created_at = sql_lib.DATE(storage="epoch")
+
+    def setUp(self):
+        super().setUp()
+        self.db = sql_lib.DBManager(self.path, tables=[sql_lib.Table("users", self.User)])
+        self.addCleanup(self.db.close)
+
+    def write(self, name, text):
+        path = self.temp_path(name)
+        with open(path, "w") as file:
+            file.write(text)
+        return path
+
+    def test_csv(self):
+        path = self.write("users.csv", "username,ignored,score,created_at\n"
+                                       "ann,x,1.5,2020-01-02 03:04:05\n"
+                                       "\"o'brien, bob\",y,,2020-01-03\n"
+                                       "carl,z,3,\n")
+        progress = []
+
+        stats = self.db.import_file(self.User, path, chunk_size=2, defer_indexes=True, profile="bulk_load",
+                                    progress=lambda x: progress.append(x.rows))
+
+        self.assertEqual(3, stats.rows)
+        self.assertEqual([2, 3], progress)
+        self.assertEqual([(1, "ann", 1.5, sql_lib.Date(2020, 1, 2, 3, 4, 5)),
+                          (2, "o'brien, bob", None, sql_lib.Date(2020, 1, 3)),
+                          (3, "carl", 3., None)],
+                         [tuple(entry) for entry in self.db.get_entries(self.User)])
+
+        self.db.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'users_username_idx'")
+        self.assertEqual(1, self.db.cursor.fetchone()[0])
+        self.db.execute("PRAGMA synchronous")
+        self.assertEqual(2, self.db.cursor.fetchone()[0])
+
+    def test_jsonl(self):
+        path = self.write("users.jsonl", '{"id": 7, "username": "ann", "score": 2}\n\n'
+                                         '{"id": 9, "username": "bob"}\n')
+
+        self.assertEqual(2, self.db.import_file(self.User, path).rows)
+        self.assertEqual([(7, "ann", 2.), (9, "bob", None)],
+                         [tuple(entry)[:3] for entry in self.db.get_entries(self.User)])
+
+    def test_csv_short_row(self):
+        path = self.write("users.csv", "username,score\nann,1\nbob\n")
+
+        with self.assertRaisesRegex(ValueError, "Line 3"):
+            self.db.import_file(self.User, path)
+
+    def test_jsonl_keys_after_first_record(self):
+        path = self.write("users.jsonl", '{"username": "ann"}\n{"username": "bob", "score": 2.5}\n')
+
+        self.db.import_file(self.User, path)
+        self.assertEqual([(1, "ann", None), (2, "bob", 2.5)],
+                         [tuple(entry)[:3] for entry in self.db.get_entries(self.User)])
+
+    def test_epoch_values(self):
+        self.write("users.jsonl", '{"username": "ann", "created_at": 1588636800}\n')
+        self.write("users.csv", "username,created_at\nbob,1588636800\n")
+
+        self.db.import_file(self.User, self.temp_path("users.jsonl"))
+        self.db.import_file(self.User, self.temp_path("users.csv"))
+        self.assertEqual([sql_lib.Date(2020, 5, 5)] * 2,
+                         [entry.created_at for entry in self.db.get_entries(self.User)])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            self.db.import_file(self.User, self.write("users.xml", ""))
+
+
+class BatchTest(unittest.TestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT()
+        score = sql_lib.REAL()
+
+    def setUp(self):
+        self.db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("users", self.User)])
+        self.addCleanup(self.db.close)
+        self.db.insert_entries([self.User(username=name, score=1.) for name in "abc"])
+
+    def rows(self):
+        return [tuple(entry) for entry in self.db.get_entries(self.User)]
+
+    def test_statements(self):
+        table = self.db.tables[self.User]
+        self.assertEqual('INSERT INTO users (id, username, score) VALUES (?, ?, ?) '
+                         'ON CONFLICT (id) DO UPDATE SET username = excluded.username, score = excluded.score',
+                         table.upsert_statement())
+        self.assertEqual('INSERT INTO users (id, username, score) VALUES (?, ?, ?) ON CONFLICT (id) DO NOTHING',
+                         table.upsert_statement(()))
+        self.assertEqual('UPDATE users SET score = ? WHERE id = ?', table.update_statement(("score",)))
+
+    def test_upsert(self):
+        self.assertEqual(2, self.db.upsert_entries([self.User(id=2, username="B", score=2.),
+                                                    self.User(id=4, username="d", score=4.)], chunk_size=1))
+        self.assertEqual([(1, "a", 1.), (2, "B", 2.), (3, "c", 1.), (4, "d", 4.)], self.rows())
+
+        self.db.upsert_entries([self.User(id=1, username="A", score=5.)], columns=("score",))
+        self.assertEqual((1, "a", 5.), self.rows()[0])
+
+    def test_upsert_ignore(self):
+        self.db.upsert_entries([self.User(id=1, username="A"), self.User(id=5, username="e")], conflict="ignore")
+        self.assertEqual(["a", "b", "c", "e"], [row[1] for row in self.rows()])
+
+        with self.assertRaises(ValueError):
+            self.db.upsert_entries([], conflict="replace")
+
+    def test_upsert_without_key(self):
+        with self.assertRaises(ValueError):
+            self.db.upsert_entries([self.User(id=4, username="d"), self.User(username="e")])
+        self.assertEqual(["a", "b", "c"], [row[1] for row in self.rows()])
+
+        entry = self.User().set_vals(5, "e", 0., primary_key=True)
+        self.assertEqual(1, self.db.upsert_entries([entry]))
+        self.assertEqual((5, "e", 0.), self.rows()[-1])
+
+    def test_update(self):
+        entries = [*self.db.get_entries(self.User)]
+        for entry in entries:
+            entry.username, entry.score = entry.username.upper(), 3.
+
+        self.assertEqual(3, self.db.update_entries(entries, columns=["score"]))
+        self.assertEqual([(1, "a", 3.), (2, "b", 3.), (3, "c", 3.)], self.rows())
+        self.assertEqual(3, self.db.update_entries(entries))
+        self.assertEqual([(1, "A", 3.), (2, "B", 3.), (3, "C", 3.)], self.rows())
+
+    def test_delete(self):
+        self.assertEqual(1, self.db.delete_entries([self.User(id=2)]))
+        self.assertEqual(1, self.db.delete_entries([3, 9], entry_type=self.User))
+        self.assertEqual([(1, "a", 1.)], self.rows())
+
+    def test_rollback(self):
+        class Unknown(sql_lib.Entry):
+            id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+
+        with self.assertRaises(KeyError):
+            self.db.delete_entries([self.User(id=1), Unknown(id=2)])
+        self.assertEqual(["a", "b", "c"], [row[1] for row in self.rows()])
+
+
+class CacheTest(unittest.TestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT()
+
+    def setUp(self):
+        self.db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("users", self.User, cache_size=2)])
+        self.addCleanup(self.db.close)
+        self.db.insert_entries([self.User(username=name) for name in "abcd"])
+
+    def test_get(self):
+        self.assertEqual("a", self.db.get(self.User, 1).username)
+        self.assertIs(self.db.get(self.User, 1), self.db.get(self.User, 1))
+        self.assertIsNone(self.db.get(self.User, 9))
+        self.assertEqual({"hits": 2, "misses": 2, "evictions": 0, "size": 1, "hit_rate": .5}, self.db.cache_stats())
+
+    def test_get_many(self):
+        entries = self.db.get_many(self.User, [3, 9, 1, 3], chunk_size=1)
+        self.assertEqual(["c", None, "a", "c"], [entry and entry.username for entry in entries])
+        self.assertEqual('SELECT id, username FROM users WHERE id IN (?, ?)',
+                         self.db.tables[self.User].get_statement(2))
+
+        self.db.get_many(self.User, [2, 4])
+        stats = self.db.cache_stats()
+        self.assertEqual((2, 2), (stats["size"], stats["evictions"]))
+
+    def test_ttl(self):
+        cache = sql_lib.EntryCache(10, ttl=0.)
+        cache.put(1, "entry")
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(0, len(cache))
+
+    def test_invalidation(self):
+        entry = self.db.get(self.User, 1)
+        entry.username = "A"
+        self.db.update_entries([entry])
+        self.assertIsNot(entry, self.db.get(self.User, 1))
+        self.assertEqual("A", self.db.get(self.User, 1).username)
+
+        self.db.get(self.User, 2)
+        self.db.delete_entries([2], entry_type=self.User)
+        self.assertIsNone(self.db.get(self.User, 2))
+
+        self.db.upsert_entries([self.User(id=1, username="one")])
+        self.assertEqual("one", self.db.get(self.User, 1).username)
+
+    def test_rollback_clears_cache(self):
+        with self.assertRaises(KeyError):
+            with self.db.transaction():
+                self.db.update_entries([self.User(id=1, username="x")])
+                self.assertEqual("x", self.db.get(self.User, 1).username)
+                raise KeyError
+
+        self.assertEqual("a", self.db.get(self.User, 1).username)
+
+
+class ParallelTest(TempDirTestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT()
+        created_at = sql_lib.DATE()
+
+    def setUp(self):
+        super().setUp()
+        self.db = sql_lib.DBManager(self.path, tables=[sql_lib.Table("users", self.User)])
+        self.addCleanup(self.db.close)
+        self.db.insert_entries(self.User(username=str(i), created_at=sql_lib.Date(2020, 1, 1 + i % 28))
+                               for i in range(100))
+
+    def test_ordered(self):
+        self.assertEqual([(i + 1, str(i), sql_lib.Date(2020, 1, 1 + i % 28)) for i in range(100)],
+                         [*self.db.parallel_map(self.User, tuple, workers=2, shards=7)])
+
+    def test_unordered_chunks(self):
+        sizes = [*self.db.parallel_map(self.User, len, workers=2, shards=3, per_chunk=True, ordered=False,
+                                       arraysize=10)]
+        self.assertEqual(100, sum(sizes))
+        self.assertEqual(10, max(sizes))
+
+    def test_reduce(self):
+        self.assertEqual(5050, self.db.parallel_map(self.User, sql_lib.Entry.get_key, workers=2, reduce=operator.add))
+        self.db.delete_entries(range(1, 101), entry_type=self.User)
+        self.assertIsNone(self.db.parallel_map(self.User, sql_lib.Entry.get_key, workers=2, reduce=operator.add))
+
+    def test_local_entry_class(self):
+        class Local(sql_lib.Entry):
+            id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+            username = sql_lib.TEXT()
+            created_at = sql_lib.DATE()
+
+        db = sql_lib.DBManager(self.temp_path("local.db"), tables=[sql_lib.Table("users", Local)])
+        self.addCleanup(db.close)
+        db.insert_entries(Local(username=str(i), created_at=sql_lib.Date(2020, 1, 2)) for i in range(5))
+
+        with self.assertRaisesRegex(TypeError, "Local"):
+            db.parallel_map(Local, tuple, workers=2)
+
+    def test_in_memory(self):
+        db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("users", self.User)])
+        self.addCleanup(db.close)
+        with self.assertRaises(ValueError):
+            db.parallel_map(self.User, tuple)
+
+
+class InMemoryTest(TempDirTestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT() + sql_lib.SQLParams.INDEX
+
+    def open(self, **kwargs):
+        db = sql_lib.DBManager(self.path, tables=[sql_lib.Table("users", self.User)], in_memory=True, **kwargs)
+        self.addCleanup(db.close)
+        return db
+
+    def on_disk(self):
+        connection = sqlite3.connect(self.path)
+        try:
+            return [row[0] for row in connection.execute("SELECT username FROM users")]
+        finally:
+            connection.close()
+
+    def test_snapshot_on_close_and_load(self):
+        db = self.open()
+        db.insert_entries([self.User(username="a")])
+        self.assertFalse(os.path.exists(self.path))
+        db.close()
+        self.assertEqual(["a"], self.on_disk())
+
+        db = self.open()
+        self.assertEqual(["a"], [entry.username for entry in db.get_entries(self.User)])
+
+    def test_checkpoint(self):
+        db = self.open(snapshot_pages=1, snapshot_sleep=0.)
+        db.insert_entries([self.User(username=str(i)) for i in range(100)])
+        self.assertTrue(db.checkpoint())
+        self.assertFalse(db.checkpoint())
+        self.assertEqual(100, len(self.on_disk()))
+
+        with self.assertRaises(ValueError):
+            with db.transaction():
+                db.checkpoint()
+
+    def test_periodic_snapshots(self):
+        db = self.open(snapshot_interval=10)
+        db.insert_entries([self.User(username="a")])
+        for _ in range(100):
+            if os.path.exists(self.path):
+                break
+            threading.Event().wait(.01)
+        self.assertEqual(["a"], self.on_disk())
+
+    def test_incompatible_options(self):
+        with self.assertRaises(ValueError):
+            self.open(readers=2)
+        with self.assertRaises(ValueError):
+            self.open().parallel_map(self.User, tuple)
+        with self.assertRaises(ValueError):
+            sql_lib.DBManager(":memory:").checkpoint()
+
+
+class PaginateTest(unittest.TestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT()
+        score = sql_lib.REAL() + sql_lib.SQLParams.INDEX
+        created_at = sql_lib.DATE(storage="epoch") + sql_lib.SQLParams.INDEX
+
+    def setUp(self):
+        self.db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("users", self.User)])
+        self.addCleanup(self.db.close)
+        self.db.insert_entries(self.User(username=str(i), score=None if i % 4 == 0 else float(i % 3),
+                                         created_at=sql_lib.Date(2020, 1, 1 + i % 5)) for i in range(20))
+
+    def pages(self, **kwargs):
+        pages, token = [], None
+        while True:
+            page = self.db.paginate(self.User, token=token, **kwargs)
+            pages.append([entry.id for entry in page])
+            if not page.has_next:
+                return pages
+            token = page.token
+
+    def expected(self, sql):
+        self.db.execute(sql)
+        return [row[0] for row in self.db.cursor.fetchall()]
+
+    def test_primary_key(self):
+        self.assertEqual([[1, 2, 3, 4, 5, 6, 7], [8, 9, 10, 11, 12, 13, 14], [15, 16, 17, 18, 19, 20]],
+                         self.pages(page_size=7))
+        self.assertEqual([[20, 19, 18, 17, 16, 15, 14, 13, 12, 11], [10, 9, 8, 7, 6, 5, 4, 3, 2, 1]],
+                         self.pages(order_by=self.User.id.desc(), page_size=10, lazy=True))
+
+    def test_indexed_column(self):
+        for order_by, sql in ((self.User.score, "SELECT id FROM users ORDER BY score, id"),
+                              (self.User.score.desc(), "SELECT id FROM users ORDER BY score DESC, id DESC"),
+                              (self.User.created_at, "SELECT id FROM users ORDER BY created_at, id")):
+            pages = self.pages(order_by=order_by, page_size=3)
+            self.assertEqual(self.expected(sql), sum(pages, []))
+            self.assertTrue(all(len(page) == 3 for page in pages[:-1]))
+
+    def test_where(self):
+        pages = self.pages(order_by=self.User.score, where=self.User.id > 10, page_size=4)
+        self.assertEqual(self.expected("SELECT id FROM users WHERE id > 10 ORDER BY score, id"), sum(pages, []))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            self.db.paginate(self.User, order_by=self.User.username)
+
+        token = self.db.paginate(self.User, page_size=2).token
+        with self.assertRaises(ValueError):
+            self.db.paginate(self.User, order_by=self.User.score, token=token)
+        with self.assertRaises(ValueError):
+            self.db.paginate(self.User, token="not a token")
+        for state in (b'[["id"], false]', b'[["id"], false, 3]', b'[["id"], false, []]'):
+            with self.assertRaisesRegex(ValueError, "Invalid pagination token"):
+                self.db.paginate(self.User, token=base64.urlsafe_b64encode(state).decode())
+
+
+class AggregateTest(unittest.TestCase):
+    class Order(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        customer = sql_lib.TEXT()
+        total = sql_lib.REAL()
+        created_at = sql_lib.DATE()
+        paid_at = sql_lib.DATE(storage="epoch")
+
+    def setUp(self):
+        self.db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("orders", self.Order)])
+        self.addCleanup(self.db.close)
+        self.db.insert_entries(self.Order(customer="ab"[i % 2], total=float(i),
+                                          created_at=sql_lib.Date(2020, 1 + i % 2, 1 + i % 3, 12),
+                                          paid_at=sql_lib.Date(2021 + i % 2, 3, 4, 5)) for i in range(6))
+
+    def test_compile(self):
+        query = self.db.select(self.Order, self.Order.created_at.month, sql_lib.count(), sql_lib.sum_(self.Order.total))
+        query.group_by(self.Order.created_at.month).having(sql_lib.count() > 1)
+        self.assertEqual(('SELECT date(created_at, \'start of month\') AS "created_at_month [sqlite_lib_date]", COUNT(*), '
+                          'SUM(total) FROM orders GROUP BY date(created_at, \'start of month\') HAVING COUNT(*) > ?',
+                          [1]), query.sql())
+        self.assertEqual("date(paid_at, 'unixepoch', 'start of year')", self.Order.paid_at.year.__sql__([]))
+
+    def test_totals(self):
+        self.assertEqual([(6, 15., 2.5, 0., 5.)],
+                         self.db.aggregate(self.Order, sql_lib.count(), sql_lib.sum_(self.Order.total),
+                                           sql_lib.avg(self.Order.total), sql_lib.min_(self.Order.total),
+                                           sql_lib.max_(self.Order.total)))
+        self.assertEqual([(2,)], self.db.aggregate(self.Order, sql_lib.count(self.Order.customer, distinct=True)))
+
+    def test_group_by(self):
+        self.assertEqual([(sql_lib.Date(2020, 1, 1), 1), (sql_lib.Date(2020, 1, 2), 1), (sql_lib.Date(2020, 1, 3), 1),
+                          (sql_lib.Date(2020, 2, 1), 1), (sql_lib.Date(2020, 2, 2), 1), (sql_lib.Date(2020, 2, 3), 1)],
+                         self.db.aggregate(self.Order, sql_lib.count(), group_by=self.Order.created_at.day))
+        self.assertEqual({"paid_at_year": [sql_lib.Date(2022, 1, 1)], "customer": ["b"], "revenue": [9.]},
+                         self.db.aggregate(self.Order, sql_lib.sum_(self.Order.total).alias("revenue"),
+                                           group_by=(self.Order.paid_at.year, self.Order.customer),
+                                           where=self.Order.id > 1, having=sql_lib.sum_(self.Order.total) > 6,
+                                           columnar=True))
+
+    def test_columnar_empty(self):
+        self.assertEqual({"customer": [], "count": []},
+                         self.db.aggregate(self.Order, sql_lib.count(), group_by=self.Order.customer,
+                                           where=self.Order.id > 10, columnar=True))
+
+
+class SchemaTest(TempDirTestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT()
+
+    class UserV2(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT()
+        score = sql_lib.REAL() + sql_lib.SQLParams.INDEX
+
+    def open(self, entry_type):
+        statements = []
+        db = sql_lib.DBManager(self.path, tables=[sql_lib.Table("users", entry_type)],
+                               hooks=[lambda event: statements.append(event.sql)])
+        self.addCleanup(db.close)
+        return db, statements
+
+    def test_skip_when_unchanged(self):
+        db, statements = self.open(self.User)
+        self.assertEqual(["CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY,\nusername TEXT)",
+                          f"PRAGMA user_version = {db.schema_fingerprint()}"], statements)
+        db.close()
+
+        db, statements = self.open(self.User)
+        self.assertEqual([], statements)
+
+    def test_additive_migration(self):
+        db, _ = self.open(self.User)
+        db.insert_entries([self.User(username="a")])
+        fingerprint = db.schema_fingerprint()
+        db.close()
+
+        db, statements = self.open(self.UserV2)
+        self.assertNotEqual(fingerprint, db.schema_fingerprint())
+        self.assertEqual(["ALTER TABLE users ADD COLUMN score REAL",
+                          "CREATE INDEX IF NOT EXISTS users_score_idx ON users (score)",
+                          f"PRAGMA user_version = {db.schema_fingerprint()}"], statements)
+        self.assertEqual([(1, "a", None)], [tuple(entry) for entry in db.get_entries(self.UserV2)])
+
+    def test_not_null_and_unique_columns(self):
+        class UserV3(sql_lib.Entry):
+            id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+            username = sql_lib.TEXT()
+            level = sql_lib.INTEGER() + sql_lib.SQLParams.NOT_NULL
+            joined = sql_lib.DATE(storage="epoch") + sql_lib.SQLParams.NOT_NULL
+
+        class UserV4(UserV3):
+            email = sql_lib.TEXT() + sql_lib.SQLParams.UNIQUE
+
+        db, _ = self.open(self.User)
+        db.insert_entries([self.User(username="a")])
+        db.close()
+
+        db, statements = self.open(UserV3)
+        self.assertEqual(["ALTER TABLE users ADD COLUMN level INTEGER NOT NULL DEFAULT 0",
+                          "ALTER TABLE users ADD COLUMN joined INTEGER NOT NULL DEFAULT 0"], statements[:2])
+        self.assertEqual([(1, "a", 0, sql_lib.Date())], [tuple(entry) for entry in db.get_entries(UserV3)])
+        db.close()
+
+        db, statements = self.open(UserV4)
+        self.assertEqual(["ALTER TABLE users ADD COLUMN email TEXT",
+                          "CREATE UNIQUE INDEX IF NOT EXISTS users_email_idx ON users (email)"],
+                         [sql for sql in statements if "email" in sql])
+        db.insert_entries([UserV4(username="b", email="b@x")])
+        with self.assertRaises(sqlite3.IntegrityError):
+            db.insert_entries([UserV4(username="c", email="b@x")])
+
+        with self.assertRaisesRegex(ValueError, "PRIMARY KEY"):
+            sql_lib.Table("users", UserV4).migrate(["username"])
+
+
+class Customer(sql_lib.Entry):
+    id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+    username = sql_lib.TEXT()
+
+
+class Order(sql_lib.Entry):
+    id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+    user = sql_lib.REFERENCE(Customer, on_delete="CASCADE") + sql_lib.SQLParams.INDEX
+    total = sql_lib.REAL()
+
+
+class ReferenceTest(unittest.TestCase):
+    def setUp(self):
+        statements = []
+        self.db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("users", Customer),
+                                                        sql_lib.Table("orders", Order)],
+                                    hooks=[lambda event: statements.append(event.sql)], arraysize=4)
+        self.addCleanup(self.db.close)
+        self.statements = statements
+        self.db.insert_entries([Customer(username=name) for name in "abc"])
+        orders = [Order(total=float(i)) for i in range(10)]
+        for i, order in enumerate(orders):
+            order.user = i % 2 + 1 if i < 9 else None
+        self.db.insert_entries(orders)
+        statements.clear()
+
+    def test_create(self):
+        self.assertEqual("CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY,\n"
+                         "user INTEGER REFERENCES users (id) ON DELETE CASCADE,\ntotal REAL)",
+                         self.db.tables[Order].init())
+        self.assertIsNone(Order().user)
+
+    def test_title_from_manager(self):
+        sql_lib.Table("legacy_customers", Customer)
+        with sql_lib.DBManager(":memory:", tables=[sql_lib.Table("clients", Customer),
+                                                   sql_lib.Table("purchases", Order)]) as db:
+            self.assertIn("REFERENCES clients (id)", db.tables[Order].init())
+            db.insert_entries([Customer(username="a")])
+            self.assertEqual(1, db.insert_entries([Order(user=1)]))
+
+        with self.assertRaises(ValueError):
+            sql_lib.DBManager(":memory:", tables=[sql_lib.Table("purchases", Order)])
+
+    def test_prefetch(self):
+        orders = self.db.select(Order).prefetch(Order.user).all()
+
+        self.assertEqual(["a", "b"] * 4 + ["a", None],
+                         [order.related(Order.user) and order.related(Order.user).username
+                          for order in orders])
+        self.assertEqual(4, len(self.statements))
+        with self.assertRaises(KeyError):
+            next(self.db.get_entries(Order)).related(Order.user)
+
+    def test_foreign_keys(self):
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.db.insert_entries([Order(user=9)])
+
+        self.db.delete_entries([1], entry_type=Customer)
+        self.assertEqual([2, 4, 6, 8, 10], [order.id for order in self.db.get_entries(Order)])
+
+        order = Order()
+        order.user = Customer(id=2)
+        self.assertEqual(2, order.user)
+        self.assertEqual(5, Order(user=Customer(id=5)).user)
+
+
+class FlushTest(unittest.TestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT()
+        score = sql_lib.REAL()
+
+    def setUp(self):
+        statements = []
+        self.db = sql_lib.DBManager(":memory:", tables=[sql_lib.Table("users", self.User)],
+                                    hooks=[lambda event: statements.append(event.sql)])
+        self.addCleanup(self.db.close)
+        self.statements = statements
+        self.db.insert_entries([self.User(username=name, score=1.) for name in "abcd"])
+        statements.clear()
+
+    def rows(self):
+        return [tuple(entry) for entry in self.db.get_entries(self.User)]
+
+    def test_dirty_fields(self):
+        entry = next(self.db.get_entries(self.User, lazy=True))
+        self.assertFalse(entry.is_dirty())
+        entry.score = 2.
+        entry.username = "A"
+        self.assertEqual(("username", "score"), entry.dirty_fields())
+        self.assertFalse(entry.mark_clean().is_dirty())
+
+    def test_flush(self):
+        a, b, c, d = self.db.get_entries(self.User)
+        a.score, b.score, c.username = 2., 3., "C"
+        self.statements.clear()
+
+        self.assertEqual(3, self.db.flush([a, b, c, d]))
+        self.assertEqual(["UPDATE users SET score = ? WHERE id = ?", "UPDATE users SET username = ? WHERE id = ?"],
+                         self.statements)
+        self.assertEqual([(1, "a", 2.), (2, "b", 3.), (3, "C", 1.), (4, "d", 1.)], self.rows())
+        self.assertFalse(any(entry.is_dirty() for entry in (a, b, c, d)))
+        self.assertEqual(0, self.db.flush([a, b, c, d]))
+
+    def test_session(self):
+        with self.db.session() as session:
+            for entry in session.track(self.db.get_entries(self.User)):
+                if entry.id % 2:
+                    entry.score = 5.
+            self.assertEqual(2, len(session.dirty()))
+        self.assertEqual([5., 1., 5., 1.], [row[2] for row in self.rows()])
+
+        with self.assertRaises(KeyError):
+            with self.db.session() as session:
+                entry = next(self.db.get_entries(self.User))
+                session.add(entry)
+                entry.score = 0.
+                raise KeyError
+        self.assertEqual(5., self.rows()[0][2])
+
+    def test_changed_primary_key(self):
+        entry = next(self.db.get_entries(self.User))
+        entry.id, entry.username = 9, "x"
+        with self.assertRaises(ValueError):
+            self.db.flush([entry])
+        self.assertEqual("a", self.rows()[0][1])
+
+    def test_writes_clear_dirty(self):
+        a, b, *_ = self.db.get_entries(self.User)
+        a.score, b.username = 2., "B"
+        self.db.update_entries([a], ["score"])
+        self.db.upsert_entries([b])
+        self.statements.clear()
+
+        self.assertEqual(0, self.db.flush([a, b]))
+        self.assertEqual([], self.statements)
+
+    def test_unsaved_entry(self):
+        entry = self.User(username="e")
+        entry.score = 2.
+        with self.assertRaises(ValueError):
+            self.db.flush([entry])
+
+        self.db.insert_entries([entry])
+        entry.score = 3.
+        with self.assertRaises(ValueError):
+            self.db.flush([entry])
+
+        entry = self.User(id=9, username="f")
+        self.db.insert_entries([entry], primary_key=True)
+        entry.score = 4.
+        self.assertEqual(1, self.db.flush([entry]))
+        self.assertEqual((9, "f", 4.), self.rows()[-1])
+
+
+class TransactionTest(TempDirTestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT()
+
+    def open(self, **kwargs):
+        return sql_lib.DBManager(self.path, tables=[sql_lib.Table("users", self.User)], **kwargs)
+
+    def committed(self):
+        connection = sqlite3.connect(self.path)
+        try:
+            return [row[0] for row in connection.execute("SELECT username FROM users ORDER BY id")]
+        finally:
+            connection.close()
+
+    def test_commit_at_end_of_block(self):
+        db = self.open()
+        with db.transaction():
+            db.insert_entries([self.User(username="a"), self.User(username="b")])
+            self.assertEqual([], self.committed())
+        self.assertEqual(["a", "b"], self.committed())
+
+    def test_rollback_on_exception(self):
+        db = self.open()
+        with self.assertRaises(KeyError):
+            with db.transaction():
+                db.insert_entries([self.User(username="a")])
+                raise KeyError
+        self.assertFalse(db.in_transaction())
+        self.assertEqual([], self.committed())
+
+    def test_nested_savepoint_rollback(self):
+        db = self.open()
+        with db.transaction():
+            db.insert_entries([self.User(username="outer")])
+            with self.assertRaises(KeyError):
+                with db.transaction():
+                    db.insert_entries([self.User(username="inner")])
+                    raise KeyError
+        self.assertEqual(["outer"], self.committed())
+
+    def test_commit_every(self):
+        db = self.open(commit_every=3)
+        for name in "abc":
+            self.assertEqual([], self.committed())
+            db.insert_entries([self.User(username=name)])
+        self.assertEqual(["a", "b", "c"], self.committed())
+
+    def test_commit_interval(self):
+        db = self.open(commit_every=None, commit_interval=0)
+        db.insert_entries([self.User(username="a")])
+        self.assertEqual(["a"], self.committed())
+
+    def test_commit_interval_when_idle(self):
+        db = self.open(commit_every=0, commit_interval=50)
+        self.addCleanup(db.close)
+        db.insert_entries([self.User(username="a")])
+        self.assertEqual([], self.committed())
+
+        deadline = time.monotonic() + 2
+        while not self.committed() and time.monotonic() < deadline:
+            time.sleep(.01)
+        self.assertEqual(["a"], self.committed())
+
+
+class ProfileTest(TempDirTestCase):
+    def pragma(self, connection, key):
+        return connection.execute(f"PRAGMA {key}").fetchone()[0]
+
+    def test_profile_and_overrides(self):
+        db = sql_lib.DBManager(self.path, profile="balanced", pragmas={"cache_size": -1024, "page_size": 8192})
+        self.addCleanup(db.close)
+
+        self.assertEqual("wal", self.pragma(db.connection, "journal_mode"))
+        self.assertEqual(1, self.pragma(db.connection, "synchronous"))
+        self.assertEqual(-1024, self.pragma(db.connection, "cache_size"))
+        self.assertEqual(8192, self.pragma(db.connection, "page_size"))
+
+    def test_unknown_pragma(self):
+        with self.assertRaises(ValueError):
+            sql_lib.DBManager(self.path, pragmas={"legacy_file_format": 1})
+        with self.assertRaisesRegex(ValueError, "Unknown profile: fast"):
+            sql_lib.DBManager(self.path, profile="fast")
+
+    def test_readers_get_profile(self):
+        db = sql_lib.DBManager(self.path, profile="durable", pragmas={"cache_size": -2048}, readers=1)
+        self.addCleanup(db.close)
+
+        self.assertEqual("wal", self.pragma(db.connection, "journal_mode"))
+        with db.pool.connection() as reader:
+            self.assertEqual(-2048, self.pragma(reader, "cache_size"))
+            self.assertEqual(5000, self.pragma(reader, "busy_timeout"))
+
+    def test_use_profile(self):
+        db = sql_lib.DBManager(self.path, profile="durable")
+        self.addCleanup(db.close)
+
+        with db.use_profile("bulk_load", cache_size=-4096):
+            self.assertEqual("memory", self.pragma(db.connection, "journal_mode"))
+            self.assertEqual(0, self.pragma(db.connection, "synchronous"))
+            self.assertEqual(-4096, self.pragma(db.connection, "cache_size"))
+
+        self.assertEqual("delete", self.pragma(db.connection, "journal_mode"))
+        self.assertEqual(2, self.pragma(db.connection, "synchronous"))
+        self.assertEqual(-2000, self.pragma(db.connection, "cache_size"))
+
+
+class PoolTest(TempDirTestCase):
+    class User(sql_lib.Entry):
+        id = sql_lib.INTEGER() + sql_lib.SQLParams.PRIMARY_KEY
+        username = sql_lib.TEXT()
+
+    def setUp(self):
+        super().setUp()
+        self.db = sql_lib.DBManager(self.path,
+                                    tables=[sql_lib.Table("users", self.User)], readers=2, pool_timeout=.1)
+        self.addCleanup(self.db.close)
+
+    def test_wal(self):
+        self.db.execute("PRAGMA journal_mode")
+        self.assertEqual("wal", self.db.cursor.fetchone()[0])
+
+    def test_concurrent_readers(self):
+        self.db.insert_entries([self.User(username=str(i)) for i in range(100)])
+        results = []
+
+        def read():
+            results.append(sum(1 for _ in self.db.get_entries(self.User, arraysize=10)))
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([100] * 4, results)
+
+    def test_reads_in_transaction(self):
+        with self.db.transaction():
+            self.db.insert_entries([self.User(username="a")])
+            self.assertEqual(["a"], [entry.username for entry in self.db.get_entries(self.User)])
+
+            with self.db.pool.connection() as reader:
+                self.assertEqual([], reader.execute("SELECT * FROM users").fetchall())
+
+    def test_reads_pending_batch(self):
+        db = sql_lib.DBManager(self.path, tables=[sql_lib.Table("users", self.User)], readers=1, commit_every=100)
+        self.addCleanup(db.close)
+        db.insert_entries([self.User(username="a"), self.User(username="b")])
+
+        self.assertEqual(["a", "b"], [entry.username for entry in db.get_entries(self.User)])
+        with db.pool.connection() as reader:
+            self.assertEqual([], reader.execute("SELECT * FROM users").fetchall())
+        db.commit()
+        with db.pool.connection() as reader:
+            self.assertEqual(2, len(reader.execute("SELECT * FROM users").fetchall()))
+
+    def test_pool_timeout(self):
+        held = [self.db.pool.acquire(), self.db.pool.acquire()]
+        with self.assertRaises(TimeoutError):
+            self.db.pool.acquire()
+        for connection in held:
+            self.db.pool.release(connection)
+
+    def test_close(self):
+        self.db.close()
+        self.db.close()
+        self.assertIsNone(self.db.connection)
+
 
 if __name__ == '__main__':
     unittest.main()